@@ -0,0 +1,84 @@
+import os
+os.environ["KERAS_BACKEND"] = "jax" # you can also use tensorflow or torch
+os.environ["XLA_PYTHON_CLIENT_MEM_FRACTION"] = "1.00" # avoid memory fragmentation on JAX backend.
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+from inference.engine import InferenceEngine
+from inference.sharding import predict_sharded
+from training.adapters import load_finetuned
+
+"""# Inference workers benchmark
+
+Generates rewrite prompts for a sample of rows with every number of `--workers`, splitting the distinct prompts into that many shards decoded concurrently by threads against the one loaded model (see `predict_sharded`). Every setting runs in its own process after a warmup of every length bucket, so compilation is not timed. Reports the rows generated per second and the speedup over a single worker.
+"""
+
+parser = argparse.ArgumentParser(description='Compare inference throughput across numbers of worker threads.')
+parser.add_argument('--model_path', type=str, required=True,
+                    help='Path of the fine-tuned model, as LoRA adapters (.npz) or a full .keras file')
+parser.add_argument('--test_file', type=str, required=True,
+                    help='Path of the dataset whose rows are used as prompts')
+parser.add_argument('--num_rows', type=int, default=64,
+                    help='Number of rows to generate for')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                    help='Numbers of worker threads to compare')
+parser.add_argument('--inference_batch_size', type=int, default=8,
+                    help='Number of prompts generated together')
+parser.add_argument('--sequence_length', type=int, default=512,
+                    help='Sequence length the model was fine-tuned with; longer prompts are truncated like in training')
+parser.add_argument('--response_budget', type=int, default=64,
+                    help='Maximum number of tokens of the rewrite prompt kept in a training sequence')
+parser.add_argument('--max_new_tokens', type=int, default=64,
+                    help='Maximum number of tokens generated for every prompt')
+parser.add_argument('--run_one', type=int, default=None,
+                    help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+template = """Instruction:\nBelow, the `Original Text` passage has been rewritten/transformed/improved into `Rewritten Text` by the `Gemma 7b-it` LLM with a certain prompt/instruction. Your task is to carefully analyze the differences between the `Original Text` and `Rewritten Text`, and try to infer the specific prompt or instruction that was likely given to the LLM to rewrite/transform/improve the text in this way.\n\nOriginal Text:\n{original_text}\n\nRewriten Text:\n{rewritten_text}\n\nResponse:\n{rewrite_prompt}"""
+
+
+def run_one(num_workers):
+    """Generates for the sample with `num_workers` threads in this process and returns its stats."""
+    df = pd.read_csv(args.test_file).head(args.num_rows)
+    df['original_text'] = df['original_text'].fillna("")
+    df['rewritten_text'] = df['rewritten_text'].fillna("")
+
+    gemma_lm, vocabulary = load_finetuned(args.model_path)
+    engine = InferenceEngine(gemma_lm, template,
+                             batch_size=args.inference_batch_size,
+                             max_new_tokens=args.max_new_tokens,
+                             sequence_length=args.sequence_length,
+                             response_budget=args.response_budget,
+                             vocabulary=vocabulary)
+    engine.warmup()
+    start = time.perf_counter()
+    predict_sharded(engine, df, num_workers)
+    elapsed = time.perf_counter() - start
+    return {"num_workers": num_workers, "rows": len(df), "seconds": elapsed,
+            "rows_per_sec": len(df) / elapsed, "tokens_per_sec": engine.generated_tokens / elapsed}
+
+
+if args.run_one is not None:
+    print(json.dumps(run_one(args.run_one)))
+    sys.exit()
+
+results = []
+for num_workers in args.workers:
+    command = [sys.executable, __file__, *sys.argv[1:], "--run_one", str(num_workers)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(f"{num_workers} workers failed:\n{completed.stderr[-2000:]}")
+        results.append({"num_workers": num_workers, "failed": True})
+        continue
+    results.append({**json.loads(completed.stdout.strip().splitlines()[-1]), "failed": False})
+
+report = pd.DataFrame(results).set_index("num_workers").sort_index()
+if 1 in report.index and "rows_per_sec" in report:
+    report["speedup"] = report["rows_per_sec"] / report.loc[1, "rows_per_sec"]
+print(report)
@@ -0,0 +1,121 @@
+import os
+os.environ["KERAS_BACKEND"] = "jax" # you can also use tensorflow or torch
+os.environ["XLA_PYTHON_CLIENT_MEM_FRACTION"] = "1.00" # avoid memory fragmentation on JAX backend.
+
+import argparse
+import itertools
+import json
+import subprocess
+import sys
+
+import keras
+import keras_nlp
+
+import numpy as np
+import pandas as pd
+
+from training.distribution import data_parallel
+from training.precision import LossScaleCheck, StepStats, set_precision
+from training.trainer import CausalLMTrainer
+
+"""# Training memory benchmark
+
+Trains the LoRA weights of a preset for a few steps on random token sequences for every combination of `--precisions`, `--sequence_lengths` and `--remat_every` and reports the median step time and the peak memory of each. Every combination runs in its own process, so peak memory is not carried over from one run to the next, and a run that does not fit in memory is reported as failed instead of ending the benchmark. With several `--devices` counts, each run trains data-parallel with `--batch_size` rows per device and the report adds its throughput relative to a perfect linear scaling from one device; `--host_devices` exposes that many CPU devices to try it without accelerators. As a safety check on training without loss scaling, the loss of the untrained model on the same batch must agree with the float32 one with the same sequence length and devices within `--loss_rtol`.
+"""
+
+parser = argparse.ArgumentParser(description='Compare training step time and memory across settings.')
+parser.add_argument('--preset', type=str, default='gemma_instruct_2b_en',
+                    help='Name of the pretrained Gemma model')
+parser.add_argument('--sequence_lengths', type=int, nargs='+', default=[512, 1024, 2048],
+                    help='Lengths of the training sequences to compare')
+parser.add_argument('--batch_size', type=int, default=1,
+                    help='Size of the input batch in training, per device')
+parser.add_argument('--steps', type=int, default=20,
+                    help='Number of training steps timed in every mode')
+parser.add_argument('--precisions', type=str, nargs='+', default=['float32', 'bfloat16'],
+                    help='Precision modes to compare')
+parser.add_argument('--remat_every', type=int, nargs='+', default=[0, 1],
+                    help='Rematerialization settings to compare (0 keeps every activation, see CausalLMTrainer)')
+parser.add_argument('--devices', type=int, nargs='+', default=[1],
+                    help='Numbers of devices to train data-parallel on')
+parser.add_argument('--host_devices', type=int, default=None,
+                    help='Number of CPU devices exposed to JAX in every run')
+parser.add_argument('--loss_rtol', type=float, default=0.02,
+                    help='Largest relative difference allowed between the initial losses of a mode and float32')
+parser.add_argument('--run_one', type=str, default=None,
+                    help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def run_one(precision, sequence_length, remat_every, num_devices):
+    """Trains with the given settings in this process and returns its stats."""
+    keras.utils.set_random_seed(0)
+    set_precision(precision)
+    if num_devices > 1:
+        num_devices = data_parallel(num_devices)
+    batch_size = args.batch_size * num_devices
+    gemma_lm = keras_nlp.models.GemmaCausalLM.from_preset(args.preset)
+    gemma_lm.backbone.enable_lora(rank=4)
+    trainer = CausalLMTrainer(gemma_lm, remat_every=remat_every)
+    trainer.compile(
+        loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        optimizer=keras.optimizers.Adam(learning_rate=3e-5),
+    )
+
+    rng = np.random.default_rng(0)
+    vocabulary_size = gemma_lm.backbone.vocabulary_size
+    token_ids = rng.integers(1, vocabulary_size, size=[batch_size * args.steps, sequence_length + 1])
+    x = {"token_ids": token_ids[:, :-1].astype("int32"),
+         "padding_mask": np.ones([len(token_ids), sequence_length], dtype=bool)}
+    y = token_ids[:, 1:].astype("int32")
+
+    probe = {key: value[:batch_size] for key, value in x.items()}
+    initial_loss = trainer.evaluate(probe, y[:batch_size], batch_size=batch_size, verbose=0)
+    step_stats = StepStats()
+    trainer.fit(x, y, batch_size=batch_size, epochs=1, verbose=0,
+                callbacks=[LossScaleCheck(), step_stats])
+    stats = step_stats.report()
+    return {"precision": precision, "sequence_length": sequence_length, "remat_every": remat_every,
+            "num_devices": num_devices, "initial_loss": float(initial_loss),
+            "tokens_per_sec": batch_size * sequence_length / stats["step_seconds"], **stats}
+
+
+if args.run_one is not None:
+    print(json.dumps(run_one(**json.loads(args.run_one))))
+    sys.exit()
+
+env = dict(os.environ)
+if args.host_devices:
+    # Read when JAX starts in the run's process.
+    env["XLA_FLAGS"] = f"{env.get('XLA_FLAGS', '')} --xla_force_host_platform_device_count={args.host_devices}".strip()
+
+results = []
+for precision, sequence_length, remat_every, num_devices in itertools.product(
+        args.precisions, args.sequence_lengths, args.remat_every, args.devices):
+    settings = {"precision": precision, "sequence_length": sequence_length, "remat_every": remat_every,
+                "num_devices": num_devices}
+    command = [sys.executable, __file__, *sys.argv[1:], "--run_one", json.dumps(settings)]
+    completed = subprocess.run(command, capture_output=True, text=True, env=env)
+    if completed.returncode != 0:
+        # Most likely out of memory at this sequence length.
+        print(f"{settings} failed:\n{completed.stderr[-2000:]}")
+        results.append({**settings, "failed": True})
+        continue
+    results.append({**json.loads(completed.stdout.strip().splitlines()[-1]), "failed": False})
+
+report = pd.DataFrame(results)
+# The probe batch, and so its loss, depends on the sequence length and the number of devices.
+probe_settings = ["sequence_length", "num_devices"]
+reference = report[(report["precision"] == "float32") & ~report["failed"]].groupby(probe_settings)["initial_loss"].first()
+if len(reference):
+    reference_loss = report.join(reference.rename("reference_loss"), on=probe_settings)["reference_loss"]
+    report["loss_rel_diff"] = (report["initial_loss"] - reference_loss).abs() / reference_loss
+    report["loss_check"] = np.where(report["loss_rel_diff"] <= args.loss_rtol, "ok",
+                                    np.where(report["loss_rel_diff"].isna(), "", "FAILED"))
+if len(args.devices) > 1 and "tokens_per_sec" in report:
+    # Throughput relative to the single-device run with the same settings times the number of devices.
+    settings = ["precision", "sequence_length", "remat_every"]
+    single = report[(report["num_devices"] == 1) & ~report["failed"]].set_index(settings)["tokens_per_sec"]
+    baseline = report.join(single.rename("single_device_tokens_per_sec"), on=settings)["single_device_tokens_per_sec"]
+    report["scaling_efficiency"] = report["tokens_per_sec"] / (baseline * report["num_devices"])
+print(report.set_index(["precision", "sequence_length", "remat_every", "num_devices"]).sort_index())
@@ -0,0 +1,102 @@
+import os
+os.environ["KERAS_BACKEND"] = "jax" # you can also use tensorflow or torch
+os.environ["XLA_PYTHON_CLIENT_MEM_FRACTION"] = "1.00" # avoid memory fragmentation on JAX backend.
+
+import argparse
+import difflib
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from inference.engine import InferenceEngine
+from inference.quantization import quantize_int8
+from training.adapters import load_finetuned
+
+"""# Int8 vs. full precision inference
+
+Loads a fine-tuned model and generates rewrite prompts for a sample of rows, once in full precision and once quantized to int8. Every mode runs in its own process, so the resident memory of one does not include the allocations and compiled programs of the other. Reports decoding throughput, resident memory, weight memory and how often both models agree.
+"""
+
+parser = argparse.ArgumentParser(description='Compare int8 and full precision inference.')
+parser.add_argument('--model_path', type=str, required=True,
+                    help='Path of the fine-tuned model, as LoRA adapters (.npz) or a full .keras file')
+parser.add_argument('--test_file', type=str, required=True,
+                    help='Path of the dataset whose rows are used as prompts')
+parser.add_argument('--num_rows', type=int, default=64,
+                    help='Number of rows to generate for')
+parser.add_argument('--inference_batch_size', type=int, default=8,
+                    help='Number of prompts generated together')
+parser.add_argument('--sequence_length', type=int, default=512,
+                    help='Sequence length the model was fine-tuned with; longer prompts are truncated like in training')
+parser.add_argument('--response_budget', type=int, default=64,
+                    help='Maximum number of tokens of the rewrite prompt kept in a training sequence')
+parser.add_argument('--max_new_tokens', type=int, default=64,
+                    help='Maximum number of tokens generated for every prompt')
+parser.add_argument('--run_one', type=str, default=None, choices=['full', 'int8'],
+                    help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+template = """Instruction:\nBelow, the `Original Text` passage has been rewritten/transformed/improved into `Rewritten Text` by the `Gemma 7b-it` LLM with a certain prompt/instruction. Your task is to carefully analyze the differences between the `Original Text` and `Rewritten Text`, and try to infer the specific prompt or instruction that was likely given to the LLM to rewrite/transform/improve the text in this way.\n\nOriginal Text:\n{original_text}\n\nRewriten Text:\n{rewritten_text}\n\nResponse:\n{rewrite_prompt}"""
+
+
+def resident_memory_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def weight_memory_mb(model):
+    return sum(np.prod(v.shape) * np.dtype(v.dtype).itemsize for v in model.weights) / 2**20
+
+
+def benchmark(gemma_lm, df, vocabulary=None):
+    engine = InferenceEngine(gemma_lm, template,
+                             batch_size=args.inference_batch_size,
+                             max_new_tokens=args.max_new_tokens,
+                             sequence_length=args.sequence_length,
+                             response_budget=args.response_budget,
+                             vocabulary=vocabulary)
+    engine.warmup()
+    start = time.perf_counter()
+    preds = engine.predict(df)
+    elapsed = time.perf_counter() - start
+    return preds, {"tokens_per_sec": engine.generated_tokens / elapsed,
+                   "seconds": elapsed,
+                   "resident_mb": resident_memory_mb(),
+                   "weights_mb": weight_memory_mb(gemma_lm)}
+
+
+def run_one(mode):
+    """Generates for the sample in `mode` in this process and returns the predictions and stats."""
+    df = pd.read_csv(args.test_file).head(args.num_rows)
+    df['original_text'] = df['original_text'].fillna("")
+    df['rewritten_text'] = df['rewritten_text'].fillna("")
+
+    gemma_lm, vocabulary = load_finetuned(args.model_path)
+    if mode == "int8":
+        quantize_int8(gemma_lm)
+    preds, stats = benchmark(gemma_lm, df, vocabulary)
+    return {"preds": preds, "stats": stats}
+
+
+if args.run_one is not None:
+    print(json.dumps(run_one(args.run_one)))
+    sys.exit()
+
+results = {}
+for mode in ["full", "int8"]:
+    command = [sys.executable, __file__, *sys.argv[1:], "--run_one", mode]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(f"{mode} failed:\n{completed.stderr[-2000:]}")
+        sys.exit(1)
+    results[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+full_preds, int8_preds = results["full"]["preds"], results["int8"]["preds"]
+
+report = pd.DataFrame([results["full"]["stats"], results["int8"]["stats"]], index=["full", "int8"])
+print(report)
+print(f"Exact agreement: {np.mean([a == b for a, b in zip(full_preds, int8_preds)]):.3f}")
+print(f"Mean similarity: {np.mean([difflib.SequenceMatcher(None, a, b).ratio() for a, b in zip(full_preds, int8_preds)]):.3f}")
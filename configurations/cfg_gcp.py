@@ -9,13 +9,85 @@ parser.add_argument('--preset', type=str, default='gemma_instruct_2b_en',
 parser.add_argument('--sequence_length', type=int, default=512,
                     help='Maximum size of input sequence for training')
 parser.add_argument('--batch_size', type=int, default=1,
-                    help='Size of the input batch in training')
+                    help='Size of the input batch in training, per device with --data_parallel')
 parser.add_argument('--epochs', type=int, default=1,
                     help='Number of epochs to train')
+parser.add_argument('--response_budget', type=int, default=64,
+                    help='Maximum number of tokens of the rewrite prompt kept in a training sequence')
+parser.add_argument('--truncation', type=str, default='middle', choices=['middle', 'head'],
+                    help='Where long original and rewritten texts are truncated to fit the sequence length')
+parser.add_argument('--token_cache_dir', type=str, default=None,
+                    help='Directory of the on-disk cache of tokenized training rows')
+parser.add_argument('--data_workers', type=int, default=2,
+                    help='Number of background threads tokenizing training batches')
+parser.add_argument('--packing', action=argparse.BooleanOptionalAction, default=False,
+                    help='Pack several training examples into each sequence')
+parser.add_argument('--max_batch_tokens', type=int, default=None,
+                    help='Batch rows of similar length up to this many tokens per device, padding included, instead of batch_size rows')
+parser.add_argument('--accum_steps', type=int, default=1,
+                    help='Number of batches whose gradients are accumulated before each optimizer update')
+parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16'],
+                    help='Compute dtype of training; weights and optimizer state stay in float32')
+parser.add_argument('--remat_every', type=int, default=0,
+                    help='Recompute the activations of every run of this many decoder blocks in the backward pass (0 to keep them)')
+parser.add_argument('--remat_blocks', type=int, nargs='*', default=[],
+                    help='Indices of decoder blocks whose activations are recomputed in the backward pass')
+parser.add_argument('--loss_chunk_size', type=int, default=None,
+                    help='Compute the LM head and the loss this many positions at a time instead of building the full logits')
+parser.add_argument('--completion_only', action=argparse.BooleanOptionalAction, default=False,
+                    help='Train only on the response tokens, running the LM head on those positions alone')
+parser.add_argument('--restrict_vocabulary', action=argparse.BooleanOptionalAction, default=False,
+                    help='Only project to the tokens of the training rewrite prompts, in training and decoding')
+parser.add_argument('--vocabulary_extra', type=str, nargs='*', default=[],
+                    help='Extra strings whose tokens are added to the restricted vocabulary')
+parser.add_argument('--vocabulary_held_out', type=float, default=0.1,
+                    help='Fraction of rewrite prompts held out to estimate the coverage of the restricted vocabulary')
+parser.add_argument('--data_parallel', action=argparse.BooleanOptionalAction, default=False,
+                    help='Split every training batch between all devices, with the model replicated on each')
+parser.add_argument('--host_devices', type=int, default=None,
+                    help='Number of CPU devices exposed to JAX, e.g. to try --data_parallel without accelerators')
+parser.add_argument('--save_format', type=str, default='adapters', choices=['adapters', 'full'],
+                    help='Save only the LoRA weights of the fine-tuned model or the whole model')
+parser.add_argument('--export_merged', action=argparse.BooleanOptionalAction, default=False,
+                    help='Fold the LoRA weights into the base kernels and save a plain inference model')
+parser.add_argument('--test_file', type=str, default=None,
+                    help='Path of the test dataset to write a submission for')
+parser.add_argument('--inference_batch_size', type=int, default=8,
+                    help='Number of prompts generated together at inference')
+parser.add_argument('--max_new_tokens', type=int, default=64,
+                    help='Maximum number of tokens generated for every prompt at inference')
+parser.add_argument('--stop_strings', type=str, nargs='*', default=['\n', 'Instruction:'],
+                    help='Strings that end a generated rewrite prompt at inference')
+parser.add_argument('--strip_prompt', type=str, default='tokens', choices=['tokens', 'text'],
+                    help='Extract answers from the generated token ids or by removing the prompt text')
+parser.add_argument('--prediction_cache', type=str, default=None,
+                    help='Path of the on-disk cache of predictions reused across inference runs')
+parser.add_argument('--prediction_cache_mb', type=int, default=256,
+                    help='Maximum size in MB of the prediction cache before old entries are evicted')
+parser.add_argument('--partial_results', type=str, default=None,
+                    help='Path of the file finished predictions are appended to, used to resume interrupted runs')
+parser.add_argument('--inference_workers', type=int, default=1,
+                    help='Number of test shards decoded concurrently against the same loaded model')
+parser.add_argument('--quantize', type=str, default=None, choices=['int8'],
+                    help='Merge LoRA and quantize the dense and attention kernels before inference')
+parser.add_argument('--length_buckets', type=int, nargs='+', default=[64, 128, 256, 512, 1024],
+                    help='Padded prompt lengths used to form inference batches with static shapes')
+parser.add_argument('--warmup', action=argparse.BooleanOptionalAction, default=True,
+                    help='Compile every length bucket before inference starts')
+parser.add_argument('--compilation_cache_dir', type=str, default=None,
+                    help='Directory where compiled XLA programs are persisted and reused across runs')
+parser.add_argument('--prefix_cache', action=argparse.BooleanOptionalAction, default=True,
+                    help='Reuse the key/value cache of the constant instruction header at inference')
 
 
 args = parser.parse_args()
 
+if args.host_devices:
+    # Only read when JAX starts its CPU backend, so this module is imported before JAX is.
+    xla_flags = [flag for flag in os.environ.get('XLA_FLAGS', '').split()
+                 if not flag.startswith('--xla_force_host_platform_device_count')]
+    os.environ['XLA_FLAGS'] = ' '.join(xla_flags + [f'--xla_force_host_platform_device_count={args.host_devices}'])
+
 class CFGGCP:
     seed = 42
     dataset_path = os.path.join(os.environ['HOME'], 'dataset_1012/')
@@ -24,4 +96,37 @@ class CFGGCP:
     preset = args.preset
     sequence_length = args.sequence_length
     batch_size = args.batch_size
-    epochs = args.epochs
\ No newline at end of file
+    epochs = args.epochs
+    response_budget = args.response_budget
+    truncation = args.truncation
+    token_cache_dir = args.token_cache_dir
+    data_workers = args.data_workers
+    packing = args.packing
+    max_batch_tokens = args.max_batch_tokens
+    accum_steps = args.accum_steps
+    precision = args.precision
+    remat_every = args.remat_every
+    remat_blocks = args.remat_blocks
+    loss_chunk_size = args.loss_chunk_size
+    completion_only = args.completion_only
+    restrict_vocabulary = args.restrict_vocabulary
+    vocabulary_extra = args.vocabulary_extra
+    vocabulary_held_out = args.vocabulary_held_out
+    data_parallel = args.data_parallel
+    host_devices = args.host_devices
+    save_format = args.save_format
+    export_merged = args.export_merged
+    test_file = args.test_file
+    inference_batch_size = args.inference_batch_size
+    max_new_tokens = args.max_new_tokens
+    stop_strings = args.stop_strings
+    strip_prompt = args.strip_prompt
+    prediction_cache = args.prediction_cache
+    prediction_cache_mb = args.prediction_cache_mb
+    partial_results = args.partial_results
+    inference_workers = args.inference_workers
+    quantize = args.quantize
+    length_buckets = args.length_buckets
+    warmup = args.warmup
+    compilation_cache_dir = args.compilation_cache_dir
+    prefix_cache = args.prefix_cache
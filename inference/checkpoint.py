@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+
+
+class PartialResults:
+    """Append-only JSON lines file of finished predictions.
+
+    Each call to `append` writes one line per id and is flushed and fsynced
+    before returning, so a preempted job loses at most the batch that was
+    being generated. A truncated last line left behind by a crash is ignored
+    by `load`. Appends are serialized, so shards decoded concurrently can
+    share one file.
+
+    With a `header` (any JSON value identifying the model, decoding settings
+    and test set), the file starts with a header record, and a file written
+    under another header is moved aside to `path + ".stale"` instead of
+    being resumed from.
+    """
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if header is not None:
+            self._check_header()
+
+    def _read_header(self):
+        with open(self.path) as f:
+            line = f.readline()
+        try:
+            return json.loads(line).get("header")
+        except (json.JSONDecodeError, AttributeError):
+            return None
+
+    def _check_header(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            if self._read_header() == self.header:
+                return
+            stale_path = self.path + ".stale"
+            os.replace(self.path, stale_path)
+            print(f"{self.path} was written for another model, settings or test set; moved it to {stale_path}.")
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"header": self.header}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        """Deletes the file, once its predictions are no longer needed."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def load(self):
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "id" not in record:
+                    continue
+                results[record["id"]] = record["rewrite_prompt"]
+        return results
+
+    def _ends_with_newline(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return True
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def append(self, ids, preds):
+        with self._lock:
+            complete = self._ends_with_newline()
+            with open(self.path, "a") as f:
+                if not complete:
+                    f.write("\n")
+                for id_, pred in zip(ids, preds):
+                    f.write(json.dumps({"id": id_, "rewrite_prompt": pred}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
@@ -0,0 +1,447 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+
+import jax
+from jax import monitoring
+import keras
+import numpy as np
+import pandas as pd
+from keras import ops
+from tqdm.auto import tqdm
+
+from inference.checkpoint import PartialResults
+from inference.fingerprint import model_fingerprint
+from inference.prediction_cache import PredictionCache
+from inference.scheduler import LengthBucketScheduler, bucket_length
+from inference.sharding import predict_sharded
+from inference.tokens import detokenize_ids
+from training.prompts import build_prompts
+from training.tokenization import TemplateTokenizer
+
+
+# Monitoring events of `jax` for every executable built (compiled or read from
+# the persistent cache) and for every persistent cache hit.
+_BACKEND_COMPILE_EVENT = "/jax/core/compile/backend_compile_duration"
+_CACHE_HIT_EVENT = "/jax/compilation_cache/cache_hits"
+_compiling = threading.local()
+
+
+def _on_backend_compile(event, *args, **kwargs):
+    engine = getattr(_compiling, "engine", None)
+    if event == _BACKEND_COMPILE_EVENT and engine is not None:
+        with engine._stats_lock:
+            engine._executables += 1
+
+
+def _on_event(event, *args, **kwargs):
+    engine = getattr(_compiling, "engine", None)
+    if event == _CACHE_HIT_EVENT and engine is not None:
+        with engine._stats_lock:
+            engine.cache_hits += 1
+
+
+monitoring.register_event_duration_secs_listener(_on_backend_compile)
+monitoring.register_event_listener(_on_event)
+
+
+class InferenceEngine:
+    """Batched prompt recovery with a reusable key/value cache for the prompt header.
+
+    Prompts are built from `template` for every row of a dataframe, sorted
+    into length buckets by `LengthBucketScheduler` and decoded greedily
+    `batch_size` at a time. Predictions are returned in the original row order.
+
+    Every row decodes at most `max_new_tokens` tokens and stops as soon as it
+    emits one of `stop_token_ids` (end of text / end of turn by default) or
+    its answer contains one of `stop_strings` (a newline after the answer or
+    a repeated `Instruction:` header); a batch ends when all its rows stop.
+
+    With `strip_prompt="tokens"` only the newly generated token ids of a row
+    are detokenized, so the answer never depends on the prompt surviving a
+    detokenization round trip. `strip_prompt="text"` keeps the old behaviour
+    of detokenizing the whole sequence and removing the prompt string.
+
+    Prompts are tokenized field by field by a `TemplateTokenizer`, with the
+    `sequence_length`, `response_budget` and `truncation` used in training,
+    so the model sees the same token ids (and never longer texts) than it
+    was fine-tuned on.
+
+    With `prefix_cache=True` the text of `template` before `{original_text}`
+    (the constant `Instruction:` header) is run through the model once, and
+    its key/value cache is copied into every batch, so only the per-row
+    suffix is prefilled. The decoding loop drives `gemma_lm.call_with_cache`
+    directly under `jax.jit`, like `gemma_lm.generate` does on the JAX backend.
+
+    Every call into the model has a static shape: batches are padded to
+    `batch_size` rows and suffixes to one of `length_buckets`, so the number
+    of XLA compilations is bounded by the number of buckets. `warmup()`
+    compiles all the ones a prompt can reach up front, and
+    `enable_compilation_cache` lets later processes reuse them. `traces`
+    counts the input shapes traced so far, `compilations` the programs XLA
+    actually compiled for them and `cache_hits` the ones loaded from the
+    persistent compilation cache instead.
+
+    With a `vocabulary` of token ids (see `training.vocabulary`), every
+    decoding step only projects to those tokens instead of the full
+    vocabulary; the stop tokens are always added to it.
+
+    Identical (`original_text`, `rewritten_text`) pairs are only generated
+    once, and with a `PredictionCache` rows already predicted by an earlier
+    run with the same template, settings and weights are not generated at all.
+    """
+
+    def __init__(self, gemma_lm, template, batch_size=8, max_new_tokens=64,
+                 length_buckets=(64, 128, 256, 512, 1024),
+                 prefix_cache=True, stop_token_ids=None, stop_strings=("\n", "Instruction:"),
+                 strip_prompt="tokens", prediction_cache=None, fallback="Improve the essay", vocabulary=None,
+                 sequence_length=512, response_budget=64, truncation="middle"):
+        if strip_prompt not in ("tokens", "text"):
+            raise ValueError(f"`strip_prompt` must be 'tokens' or 'text', received: {strip_prompt}")
+        self.gemma_lm = gemma_lm
+        self.template = template
+        self.batch_size = batch_size
+        self.max_new_tokens = max_new_tokens
+        self.strip_prompt = strip_prompt
+        self.fallback = fallback
+        self.tokenizer = gemma_lm.preprocessor.tokenizer
+        self.template_tokenizer = TemplateTokenizer(self.tokenizer, template, sequence_length,
+                                                    response_budget=response_budget, truncation=truncation)
+        self.scheduler = LengthBucketScheduler(self.tokenizer,
+                                               batch_size=batch_size,
+                                               length_buckets=length_buckets)
+        # Counters and scheduled batches are shared by the threads of `predict_sharded`.
+        self._stats_lock = threading.Lock()
+        self._scheduled_batches = []
+        self.traces = 0
+        self.cache_hits = 0
+        self._executables = 0
+        self.generated_tokens = 0
+
+        if stop_token_ids is None:
+            stop_token_ids = [self.tokenizer.end_token_id]
+            if "<end_of_turn>" in self.tokenizer.get_vocabulary():
+                stop_token_ids.append(self.tokenizer.token_to_id("<end_of_turn>"))
+        self.stop_token_ids = np.array(sorted(set(stop_token_ids)), dtype="int32")
+        self.stop_strings = tuple(stop_strings)
+        self._special_ids = {self.tokenizer.start_token_id, self.tokenizer.pad_token_id, *self.stop_token_ids.tolist()}
+        self.vocabulary = None
+        if vocabulary is not None:
+            self.vocabulary = np.union1d(vocabulary, self.stop_token_ids).astype("int32")
+
+        # The literal text before the first field, tokenized on its own like in every prompt.
+        self.prefix = self.template_tokenizer.segments[0][0] if prefix_cache else ""
+        self._forward = self._make_forward()
+        self._prefix_ids = []
+        self._prefix_cache = None
+        if self.prefix:
+            self._prefix_ids = [self.tokenizer.start_token_id] + self.template_tokenizer.literal_ids[0]
+            self._prefix_cache = self._build_prefix_cache()
+        # Prompts end where a response of the full `response_budget` and the end token would start.
+        self.max_suffix_length = sequence_length - response_budget - len(self._prefix_ids)
+
+        self.prediction_cache = prediction_cache
+        # Digest of everything that determines a prediction besides the input texts.
+        self.context = PredictionCache.make_context(
+            template=template, sampler="greedy", max_new_tokens=max_new_tokens,
+            stop_token_ids=self.stop_token_ids.tolist(), stop_strings=self.stop_strings,
+            strip_prompt=strip_prompt, model=model_fingerprint(gemma_lm),
+            # Everything that changes the prompt token ids.
+            prefix_cache=bool(self.prefix), sequence_length=sequence_length,
+            response_budget=response_budget, truncation=truncation,
+            vocabulary=None if self.vocabulary is None else self.vocabulary.tolist())
+
+    def _make_forward(self):
+        model = self.gemma_lm
+        vocabulary = self.vocabulary
+
+        @jax.jit
+        def forward(state, token_ids, cache, cache_update_index, logits_index):
+            # Only runs while tracing, i.e. once per input shape.
+            with self._stats_lock:
+                self.traces += 1
+            trainable_variables, non_trainable_variables = state
+            mapping = itertools.chain(zip(model.trainable_variables, trainable_variables),
+                                      zip(model.non_trainable_variables, non_trainable_variables))
+            with keras.StatelessScope(state_mapping=mapping):
+                _, hidden_states, cache = model.call_with_cache(token_ids, cache, cache_update_index)
+                # Project a single position to the vocabulary; XLA drops the unused full logits.
+                hidden_states = ops.take(hidden_states, logits_index, axis=1)[:, None, :]
+                if vocabulary is None:
+                    logits = model.backbone.token_embedding(hidden_states, reverse=True)
+                else:
+                    embeddings = ops.take(model.backbone.token_embedding.embeddings, vocabulary, axis=0)
+                    logits = ops.matmul(hidden_states, ops.transpose(ops.cast(embeddings, hidden_states.dtype)))
+            next_token = ops.argmax(logits[:, -1, :], axis=-1)
+            if vocabulary is not None:
+                next_token = ops.take(vocabulary, next_token)
+            return next_token, cache
+
+        def call(*args):
+            # Compilation events are reported synchronously on the calling thread.
+            _compiling.engine = self
+            try:
+                return forward(*args)
+            finally:
+                _compiling.engine = None
+
+        return call
+
+    @property
+    def compilations(self):
+        """Number of programs XLA compiled for this engine, not counting the ones read from the persistent cache."""
+        with self._stats_lock:
+            return self._executables - self.cache_hits
+
+    @property
+    def padding_report(self):
+        """Padding ratio of every length bucket over all the batches generated so far, from every thread."""
+        with self._stats_lock:
+            batches = list(self._scheduled_batches)
+        return self.scheduler.report(batches) if batches else None
+
+    def _state(self):
+        return ([v.value for v in self.gemma_lm.trainable_variables],
+                [v.value for v in self.gemma_lm.non_trainable_variables])
+
+    def _empty_cache(self, batch_size, length):
+        backbone = self.gemma_lm.backbone
+        shape = [batch_size, backbone.num_layers, 2, length, backbone.num_key_value_heads, backbone.head_dim]
+        return ops.zeros(shape, dtype=self.gemma_lm.compute_dtype)
+
+    def _build_prefix_cache(self):
+        token_ids = np.array([self._prefix_ids], dtype="int32")
+        cache = self._empty_cache(1, len(self._prefix_ids))
+        _, cache = self._forward(self._state(), token_ids, cache, np.int32(0), np.int32(0))
+        return cache
+
+    def warmup(self):
+        """Compiles the prefill and decoding step of every length bucket a prompt can be padded to."""
+        state = self._state()
+        prefix_length = len(self._prefix_ids)
+        largest = bucket_length(max(self.max_suffix_length, 1), self.scheduler.length_buckets)
+        for bucket in self.scheduler.length_buckets:
+            if bucket > largest:
+                break
+            total_length = prefix_length + bucket + self.max_new_tokens
+            cache = self._batch_cache(self.batch_size, total_length)
+            token_ids = np.zeros([self.batch_size, bucket], dtype="int32")
+            _, cache = self._forward(state, token_ids, cache, np.int32(prefix_length), np.int32(0))
+            _, cache = self._forward(state, token_ids[:, :1], cache, np.int32(prefix_length), np.int32(0))
+
+    def _batch_cache(self, batch_size, length):
+        cache = self._empty_cache(batch_size, length)
+        if self._prefix_cache is None:
+            return cache
+        prefix_cache = ops.repeat(self._prefix_cache, batch_size, axis=0)
+        return ops.slice_update(cache, [0] * len(cache.shape), prefix_cache)
+
+    def build_prompts(self, df):
+        return build_prompts(df, self.template, rewrite_prompt="")
+
+    def _suffix_ids(self, df):
+        """Prompt token ids of every row of `df` after the cached prefix."""
+        return [ids[len(self._prefix_ids):] for ids in self.template_tokenizer.prompt_ids(df)]
+
+    def _hit_stop_string(self, token_ids):
+        text = detokenize_ids(self.tokenizer, token_ids).lstrip()
+        return any(stop in text for stop in self.stop_strings)
+
+    def _truncate_at_stop(self, text):
+        text = text.lstrip()
+        for stop in self.stop_strings:
+            text = text.split(stop)[0]
+        return text.strip()
+
+    def _generate_batch(self, state, suffix_ids, padded_length):
+        """Greedily decodes one batch.
+
+        Returns the token ids of every row and the index where each row's
+        generated tokens start.
+
+        Rows are right padded to `padded_length` and the batch is topped up to
+        `batch_size` with copies of its first row. The whole padded suffix is
+        prefilled, then decoding starts at the end of the shortest prompt and
+        rows whose prompt is longer keep their own prompt tokens until it runs
+        out, like the samplers used by `gemma_lm.generate`. Cache entries
+        computed from padding are always overwritten before they are attended.
+        """
+        pad_token_id = self.tokenizer.pad_token_id
+        prefix_length = len(self._prefix_ids)
+        num_rows = len(suffix_ids)
+        suffix_ids = suffix_ids + [suffix_ids[0]] * (self.batch_size - num_rows)
+        prompt_end = prefix_length + np.array([len(ids) for ids in suffix_ids])
+        budget_end = prompt_end + self.max_new_tokens
+        total_length = prefix_length + padded_length + self.max_new_tokens
+
+        token_ids = np.full([self.batch_size, total_length], pad_token_id, dtype="int32")
+        token_ids[:, :prefix_length] = self._prefix_ids
+        for row, ids in enumerate(suffix_ids):
+            token_ids[row, prefix_length:prompt_end[row]] = ids
+
+        # Prefill the padded suffixes on top of the shared prefix cache.
+        index = int(prompt_end.min())
+        cache = self._batch_cache(self.batch_size, total_length)
+        next_token, cache = self._forward(state, token_ids[:, prefix_length:prefix_length + padded_length],
+                                          cache, np.int32(prefix_length), np.int32(index - 1 - prefix_length))
+
+        done = np.arange(self.batch_size) >= num_rows
+        while True:
+            in_prompt = index < prompt_end
+            generated = np.where(done, pad_token_id, np.asarray(next_token))
+            token_ids[:, index] = np.where(in_prompt, token_ids[:, index], generated)
+            answering = ~in_prompt & ~done
+            done |= answering & np.isin(token_ids[:, index], self.stop_token_ids)
+            if self.stop_strings:
+                for row in np.flatnonzero(answering & ~done):
+                    done[row] = self._hit_stop_string(token_ids[row, prompt_end[row]:index + 1])
+            done |= index + 1 >= budget_end
+            if done.all():
+                break
+            next_token, cache = self._forward(state, token_ids[:, index:index + 1], cache,
+                                              np.int32(index), np.int32(0))
+            index += 1
+        with self._stats_lock:
+            self.generated_tokens += int(np.clip(index + 1 - prompt_end[:num_rows], 0, self.max_new_tokens).sum())
+        return token_ids[:num_rows], prompt_end[:num_rows]
+
+    def _detokenize(self, token_ids):
+        return detokenize_ids(self.tokenizer, [i for i in token_ids if i not in self._special_ids])
+
+    def _generate(self, pairs, on_batch=None):
+        if not pairs:
+            return []
+        pairs_df = pd.DataFrame(pairs, columns=["original_text", "rewritten_text"])
+        prompts = self.build_prompts(pairs_df)
+        suffix_ids = self._suffix_ids(pairs_df)
+        batches = self.scheduler.schedule(prompts, lengths=np.array([len(ids) for ids in suffix_ids]))
+        with self._stats_lock:
+            self._scheduled_batches.extend(batches)
+
+        state = self._state()
+        preds = [None] * len(prompts)
+        for batch in tqdm(batches):
+            token_ids, prompt_end = self._generate_batch(state, [suffix_ids[i] for i in batch.indices],
+                                                         batch.padded_length)
+            for i, row_ids, row_prompt_end in zip(batch.indices, token_ids, prompt_end):
+                if self.strip_prompt == "tokens":
+                    pred = self._detokenize(row_ids[row_prompt_end:])
+                else:
+                    pred = self._detokenize(row_ids).replace(prompts[i], "") # remove the prompt from output
+                preds[i] = self._truncate_at_stop(pred)
+            if on_batch is not None:
+                on_batch(batch.indices, [preds[i] for i in batch.indices])
+        return preds
+
+    def predict(self, df, on_rows=None):
+        """Returns the predictions for every row of `df` in order.
+
+        `on_rows(row_positions, preds)` is called as soon as predictions for
+        some rows are known, either from the cache or from a finished batch.
+        """
+        pairs = list(zip(df.original_text, df.rewritten_text))
+        pair_rows = {}
+        for position, pair in enumerate(pairs):
+            pair_rows.setdefault(pair, []).append(position)
+        unique_pairs = list(pair_rows)
+
+        def report(batch_pairs, batch_preds):
+            if on_rows is None:
+                return
+            positions, preds = [], []
+            for pair, pred in zip(batch_pairs, batch_preds):
+                positions.extend(pair_rows[pair])
+                preds.extend([pred] * len(pair_rows[pair]))
+            on_rows(positions, preds)
+
+        known = {}
+        if self.prediction_cache is not None:
+            keys = {pair: self.prediction_cache.make_key(*pair, self.context) for pair in unique_pairs}
+            hits = self.prediction_cache.get_many(list(keys.values()))
+            known = {pair: hits[key] for pair, key in keys.items() if key in hits}
+            report(list(known), list(known.values()))
+
+        missing = [pair for pair in unique_pairs if pair not in known]
+
+        def on_batch(indices, preds):
+            batch_pairs = [missing[i] for i in indices]
+            if self.prediction_cache is not None:
+                self.prediction_cache.put_many({keys[pair]: pred for pair, pred in zip(batch_pairs, preds)})
+            report(batch_pairs, preds)
+
+        known.update(zip(missing, self._generate(missing, on_batch=on_batch)))
+        return [known[pair] for pair in pairs]
+
+    def predict_ids(self, df, partial=None):
+        """Returns a dict of predictions keyed by the `id` column of `df`.
+
+        With a `PartialResults` file, finished predictions are appended to it
+        after every batch and ids already present in it are not generated
+        again, so an interrupted run resumes where it stopped.
+        """
+        done = {}
+        on_rows = None
+        remaining_df = df
+        if partial is not None:
+            ids = set(df.id)
+            done = {id_: pred for id_, pred in partial.load().items() if id_ in ids}
+            remaining_df = df[~df.id.isin(list(done))]
+            remaining_ids = remaining_df.id.tolist()
+
+            def on_rows(positions, preds):
+                partial.append([remaining_ids[p] for p in positions], preds)
+
+        done.update(zip(remaining_df.id.values, self.predict(remaining_df, on_rows=on_rows)))
+        return done
+
+    def generate_submission(self, test_df, output_path="submission.csv", partial_path=None, num_workers=1):
+        """Writes the submission file for `test_df` and returns it.
+
+        With `partial_path`, progress is checkpointed as in `predict_ids`, and
+        with `num_workers > 1` the rows are split into shards decoded
+        concurrently by `predict_sharded`. The submission is only written once
+        every id has a prediction, and the partial results file is deleted
+        after it is.
+        """
+        partial = None
+        if partial_path is not None:
+            # Only resume from a file written by this model and settings for this test set.
+            partial = PartialResults(partial_path, header={"context": self.context,
+                                                           "test_set": test_set_digest(test_df)})
+        if num_workers > 1:
+            done = predict_sharded(self, test_df, num_workers, partial=partial)
+        else:
+            done = self.predict_ids(test_df, partial=partial)
+        missing_ids = [id_ for id_ in test_df.id.values if id_ not in done]
+        if missing_ids:
+            raise RuntimeError(f"{len(missing_ids)} ids have no prediction, e.g. {missing_ids[:5]}")
+
+        sub_df = pd.DataFrame({"id": test_df.id.values, "rewrite_prompt": [done[id_] for id_ in test_df.id.values]})
+        # Leaving any `rewrite_prompt` blank as null answers will throw an error.
+        sub_df['rewrite_prompt'] = sub_df['rewrite_prompt'].fillna("")
+        sub_df['rewrite_prompt'] = sub_df['rewrite_prompt'].map(lambda x: self.fallback if len(x) == 0 else x)
+        tmp_path = output_path + ".tmp"
+        sub_df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, output_path)
+        if partial is not None:
+            partial.remove()
+        return sub_df
+
+
+def test_set_digest(test_df):
+    """Digest of the ids and texts of `test_df`."""
+    rows = test_df[["id", "original_text", "rewritten_text"]].astype(str).to_numpy().tolist()
+    return hashlib.sha256(json.dumps(rows).encode()).hexdigest()
+
+
+def enable_compilation_cache(directory):
+    """Persists compiled XLA programs in `directory` so later processes can reuse them.
+
+    JAX only checks this setting at its first compilation, so this must run
+    before any model is built or called.
+    """
+    os.makedirs(directory, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", directory)
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
@@ -0,0 +1,74 @@
+import numpy as np
+from keras import ops
+
+from training.vocabulary import save_vocabulary
+
+
+def lora_layers(model):
+    return [layer for layer in model._flatten_layers() if getattr(layer, "lora_enabled", False)]
+
+
+def merge_lora(model):
+    """Folds the LoRA deltas of every layer into its kernel, in place.
+
+    After merging, the layers carry a plain kernel and no LoRA variables, so
+    the forward pass no longer runs the extra low-rank matmuls. Returns the
+    number of merged layers.
+    """
+    layers = lora_layers(model)
+    for layer in layers:
+        # `layer.kernel` already returns the kernel with the LoRA delta added.
+        layer._kernel.assign(layer.kernel)
+        layer._untrack_variable(layer.lora_kernel_a)
+        layer._untrack_variable(layer.lora_kernel_b)
+        layer.lora_kernel_a = None
+        layer.lora_kernel_b = None
+        layer.lora_enabled = False
+        layer.lora_rank = None
+        layer._kernel.trainable = True
+    return len(layers)
+
+
+def merged_state(model):
+    """Variable values of `model` as if LoRA were merged, without changing the model.
+
+    Kernels take the value of the merged kernel and the LoRA `b` matrices
+    are zeroed, so the LoRA branch adds nothing. Returns the trainable and
+    non-trainable values, for `model.stateless_call`.
+    """
+    values = {}
+    for layer in lora_layers(model):
+        values[id(layer._kernel)] = layer.kernel
+        values[id(layer.lora_kernel_b)] = ops.zeros_like(layer.lora_kernel_b)
+    return ([values.get(id(v), v.value) for v in model.trainable_variables],
+            [values.get(id(v), v.value) for v in model.non_trainable_variables])
+
+
+# Largest logit difference allowed, relative to the largest logit, for every compute dtype.
+MERGE_RTOL = {"float32": 1e-3, "bfloat16": 5e-2, "float16": 2e-2}
+
+
+def export_merged(gemma_lm, path, probe_inputs, rtol=None, vocabulary=None):
+    """Merges LoRA into `gemma_lm` in place and saves it as a plain inference model.
+
+    The logits of `probe_inputs` (a `token_ids`/`padding_mask` dict) are
+    compared with and without merging before the model is changed. If they
+    differ by more than `rtol` times the largest logit (by default, a
+    tolerance for the compute dtype: merging rounds `W + AB` once instead of
+    `W` and `AB` apart), `gemma_lm` is left untouched and nothing is saved.
+    The restricted `vocabulary` the model was trained with, if any, is saved
+    next to it. Returns the largest difference relative to the largest logit.
+    """
+    if rtol is None:
+        rtol = MERGE_RTOL.get(gemma_lm.compute_dtype, MERGE_RTOL["bfloat16"])
+    before = ops.convert_to_numpy(gemma_lm(probe_inputs)).astype("float32")
+    after, _ = gemma_lm.stateless_call(*merged_state(gemma_lm), probe_inputs)
+    after = ops.convert_to_numpy(after).astype("float32")
+    rel_diff = float(np.max(np.abs(before - after)) / max(np.max(np.abs(before)), 1e-6))
+    if rel_diff > rtol:
+        raise ValueError(f"Merged model logits differ from the LoRA model by {rel_diff:.2e} of the largest logit "
+                         f"(tolerance {rtol:.0e}); the model was not merged.")
+    merge_lora(gemma_lm)
+    gemma_lm.save(path)
+    save_vocabulary(path, vocabulary)
+    return rel_diff
@@ -0,0 +1,40 @@
+import hashlib
+import json
+
+import numpy as np
+from keras import ops
+
+
+def _update_digest(digest, variable, sample_size):
+    digest.update(f"{variable.path}:{tuple(variable.shape)}:{variable.dtype}".encode())
+    if "lora" in variable.path:
+        values = ops.convert_to_numpy(variable.value)
+    else:
+        flat = ops.reshape(variable.value, [-1])
+        values = np.concatenate([ops.convert_to_numpy(flat[:sample_size]),
+                                 ops.convert_to_numpy(flat[-sample_size:])])
+    digest.update(np.ascontiguousarray(values).tobytes())
+
+
+def model_fingerprint(gemma_lm, sample_size=1024):
+    """Returns a short digest identifying the weights of `gemma_lm`.
+
+    LoRA variables are hashed in full, since they are small and are what
+    changes between fine-tuning runs. Every other variable only contributes
+    its path, shape, dtype and its first and last `sample_size` values, which
+    is enough to tell presets, merged and quantized models apart without
+    copying billions of parameters to the host.
+    """
+    digest = hashlib.sha256(json.dumps(gemma_lm.backbone.get_config(), sort_keys=True, default=str).encode())
+    for variable in gemma_lm.backbone.weights:
+        _update_digest(digest, variable, sample_size)
+    return digest.hexdigest()[:16]
+
+
+def base_weights_checksum(backbone, sample_size=1024):
+    """Same as `model_fingerprint`, restricted to the frozen non-LoRA weights of `backbone`."""
+    digest = hashlib.sha256(json.dumps(backbone.get_config(), sort_keys=True, default=str).encode())
+    for variable in backbone.weights:
+        if "lora" not in variable.path:
+            _update_digest(digest, variable, sample_size)
+    return digest.hexdigest()[:16]
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class PredictionCache:
+    """On-disk cache of generated rewrite prompts.
+
+    Entries are keyed on a hash of the input pair and a `context` string that
+    covers everything else the prediction depends on (template, decoding
+    settings, model fingerprint). The cache lives in a single sqlite file and
+    evicts the least recently used entries once it grows past `max_bytes`.
+    It can be shared by engine threads decoding different shards.
+    """
+
+    def __init__(self, path, max_bytes=256 * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                                "key TEXT PRIMARY KEY, prediction TEXT, size INTEGER, last_access REAL)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_context(**settings):
+        return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def make_key(original_text, rewritten_text, context):
+        return hashlib.sha256(json.dumps([original_text, rewritten_text, context]).encode()).hexdigest()
+
+    def get_many(self, keys):
+        with self._lock:
+            return self._get_many(keys)
+
+    def put_many(self, predictions):
+        with self._lock:
+            self._put_many(predictions)
+
+    def _get_many(self, keys):
+        hits = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, prediction FROM predictions WHERE key IN ({placeholders})", chunk).fetchall()
+            hits.update(rows)
+        if hits:
+            now = time.time()
+            self.connection.executemany("UPDATE predictions SET last_access = ? WHERE key = ?",
+                                        [(now, key) for key in hits])
+            self.connection.commit()
+        return hits
+
+    def _put_many(self, predictions):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+            [(key, prediction, len(key) + len(prediction.encode()), now) for key, prediction in predictions.items()])
+        self.connection.commit()
+        self._evict()
+
+    def _evict(self):
+        total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self.connection.execute("SELECT key, size FROM predictions ORDER BY last_access").fetchall():
+            if total_bytes - evicted <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM predictions WHERE key = ?", (key,))
+            evicted += size
+        self.connection.commit()
@@ -0,0 +1,24 @@
+import keras
+
+from inference.export import merge_lora
+
+
+def quantize_int8(gemma_lm):
+    """Quantizes the dense and attention kernels of `gemma_lm` to int8, in place.
+
+    LoRA weights are merged first so the deltas are quantized together with
+    the kernels. Kernels get one scale per output channel (Keras' `abs_max`
+    weight-only scheme) and are dequantized on the fly in every matmul;
+    embeddings and norms stay in their original precision. Returns the
+    number of quantized layers.
+    """
+    merge_lora(gemma_lm)
+    layers = [layer for layer in gemma_lm._flatten_layers()
+              if isinstance(layer, (keras.layers.Dense, keras.layers.EinsumDense))]
+    for layer in layers:
+        layer.quantize("int8")
+    # Any compiled function holds on to the float kernels.
+    gemma_lm.train_function = gemma_lm.test_function = gemma_lm.predict_function = None
+    gemma_lm.generate_function = None
+    return len(layers)
+
@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from inference.tokens import tokenize_texts
+
+
+@dataclass
+class GenerationBatch:
+    indices: list
+    bucket: int
+    padded_length: int
+    prompt_tokens: int
+    # Rows actually decoded: batches are topped up to the engine's batch size.
+    padded_rows: int
+
+    @property
+    def padding_ratio(self):
+        return 1 - self.prompt_tokens / (self.padded_rows * self.padded_length)
+
+
+def bucket_length(length, length_buckets):
+    """Returns the smallest bucket length that fits `length`.
+
+    Lengths beyond the last bucket are rounded up to a multiple of it.
+    """
+    for bucket in length_buckets:
+        if length <= bucket:
+            return bucket
+    largest = length_buckets[-1]
+    return -(-length // largest) * largest
+
+
+class LengthBucketScheduler:
+    """Groups prompts of similar tokenized length into generation batches.
+
+    Every prompt is assigned to the smallest of `length_buckets` that fits
+    its token count and is padded up to that length, so the model only ever
+    sees a fixed set of input shapes. Batches are only formed inside a bucket
+    and in order of length, so a short prompt is never padded up to a long
+    one. Every batch carries the indices of its prompts, so results can be
+    put back in the original order.
+    """
+
+    def __init__(self, tokenizer, batch_size=8, length_buckets=(64, 128, 256, 512, 1024)):
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.length_buckets = sorted(length_buckets)
+
+    def prompt_lengths(self, prompts):
+        return np.array([len(token_ids) for token_ids in tokenize_texts(self.tokenizer, prompts)])
+
+    def schedule(self, prompts, lengths=None):
+        if lengths is None:
+            lengths = self.prompt_lengths(prompts)
+        order = np.argsort(lengths, kind="stable")
+        buckets = np.array([bucket_length(length, self.length_buckets) for length in lengths[order]])
+
+        batches = []
+        for bucket in np.unique(buckets):
+            members = order[buckets == bucket]
+            for start in range(0, len(members), self.batch_size):
+                indices = members[start:start + self.batch_size].tolist()
+                batches.append(GenerationBatch(indices=indices,
+                                               bucket=int(bucket),
+                                               padded_length=int(bucket),
+                                               prompt_tokens=int(lengths[indices].sum()),
+                                               padded_rows=self.batch_size))
+        return batches
+
+    @staticmethod
+    def report(batches):
+        """Returns the padding ratio of every bucket as a dataframe, counting the rows every batch is topped up with."""
+        rows = {}
+        for batch in batches:
+            row = rows.setdefault(batch.bucket, {"bucket": batch.bucket, "batches": 0, "prompts": 0,
+                                                 "prompt_tokens": 0, "padded_tokens": 0})
+            row["batches"] += 1
+            row["prompts"] += len(batch.indices)
+            row["prompt_tokens"] += batch.prompt_tokens
+            row["padded_tokens"] += batch.padded_rows * batch.padded_length
+        report = pd.DataFrame(list(rows.values()))
+        report["padding_ratio"] = 1 - report.prompt_tokens / report.padded_tokens
+        return report
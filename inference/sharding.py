@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def predict_sharded(engine, df, num_workers, partial=None):
+    """Splits the distinct prompts of `df` into `num_workers` shards and decodes them concurrently.
+
+    Every shard runs `engine.predict_ids` in its own worker thread against
+    the same model, so the weights are loaded and held in memory once. XLA
+    releases the GIL while a decoding step runs, which lets the shards keep
+    all CPU cores busy where a single small batch cannot. Worker processes
+    are not used because the XLA runtime's thread pools do not survive a
+    fork of an initialized JAX process.
+
+    Rows are grouped by their (`original_text`, `rewritten_text`) pair
+    before sharding, so a duplicated pair is generated once, by one shard,
+    and its prediction is given to every id that has it.
+
+    Returns a dict of predictions keyed by the `id` column, merged from all
+    shards. Ids already present in `partial` are not generated again.
+    """
+    results = {}
+    if partial is not None:
+        ids = set(df.id)
+        results.update({id_: pred for id_, pred in partial.load().items() if id_ in ids})
+        df = df[~df.id.isin(list(results))]
+
+    pair_ids = {}
+    for id_, pair in zip(df.id.values, zip(df.original_text, df.rewritten_text)):
+        pair_ids.setdefault(pair, []).append(id_)
+    pairs = list(pair_ids)
+    shards = [[pairs[p] for p in positions] for positions in np.array_split(np.arange(len(pairs)), num_workers)
+              if len(positions)]
+
+    def predict_shard(shard_pairs):
+        on_rows = None
+        if partial is not None:
+            def on_rows(positions, preds):
+                ids, id_preds = [], []
+                for position, pred in zip(positions, preds):
+                    ids.extend(pair_ids[shard_pairs[position]])
+                    id_preds.extend([pred] * len(pair_ids[shard_pairs[position]]))
+                partial.append(ids, id_preds)
+
+        shard_df = pd.DataFrame(shard_pairs, columns=["original_text", "rewritten_text"])
+        preds = engine.predict(shard_df, on_rows=on_rows)
+        return {id_: pred for pair, pred in zip(shard_pairs, preds) for id_ in pair_ids[pair]}
+
+    with ThreadPoolExecutor(max_workers=max(len(shards), 1)) as executor:
+        for shard_results in executor.map(predict_shard, shards):
+            results.update(shard_results)
+    return results
@@ -0,0 +1,29 @@
+import numpy as np
+from keras import ops
+
+
+def tokenize_texts(tokenizer, texts):
+    """Tokenizes `texts` into plain python lists of token ids, one per text."""
+    token_ids = tokenizer(list(texts))
+    if isinstance(token_ids, list):
+        # Ragged output on a non-TensorFlow backend is converted to nested python lists.
+        return [[int(token_id) for token_id in row] for row in token_ids]
+    if hasattr(token_ids, "to_list"):
+        # `tf.RaggedTensor`.
+        return token_ids.to_list()
+    # Dense tensors, when every text has the same number of tokens.
+    return [[int(token_id) for token_id in row] for row in ops.convert_to_numpy(token_ids)]
+
+
+def detokenize_ids(tokenizer, token_ids):
+    """Detokenizes a single sequence of token ids into a python string."""
+    if len(token_ids) == 0:
+        return ""
+    text = tokenizer.detokenize([int(token_id) for token_id in token_ids])
+    if hasattr(text, "numpy"):
+        text = text.numpy()
+    if isinstance(text, np.ndarray):
+        text = text.item()
+    if isinstance(text, bytes):
+        text = text.decode("utf-8")
+    return text
@@ -1,6 +1,8 @@
 import os
 os.environ["KERAS_BACKEND"] = "jax" # you can also use tensorflow or torch
 os.environ["XLA_PYTHON_CLIENT_MEM_FRACTION"] = "1.00" # avoid memory fragmentation on JAX backend.
+# Parsed before JAX is imported, so `--host_devices` can still set its XLA flags.
+from configurations.cfg import CFG
 
 import keras
 import keras_nlp
@@ -15,7 +17,27 @@ import plotly.express as px
 from IPython.display import display, Markdown
 
 """# Configuration"""
-from configurations.cfg import CFG
+from inference.engine import InferenceEngine, enable_compilation_cache
+from inference.export import export_merged
+from inference.prediction_cache import PredictionCache
+from inference.quantization import quantize_int8
+from training.adapters import save_lora_adapters
+from training.batching import token_budget_batches
+from training.completion import CompletionRows
+from training.distribution import data_parallel
+from training.packing import PackedRows
+from training.pipeline import LazyTokenizedRows, make_dataset
+from training.precision import LossScaleCheck, StepStats, set_precision
+from training.prompts import build_prompts
+from training.token_cache import TokenCache
+from training.tokenization import TemplateTokenizer
+from training.trainer import CausalLMTrainer, token_accuracy, token_loss, with_labels
+from training.vocabulary import build_vocabulary, held_out_coverage, restrict_labels, save_vocabulary
+
+# JAX decides whether to use the persistent compilation cache at its first compilation,
+# so it is enabled before anything builds or runs a model.
+if CFG.compilation_cache_dir is not None:
+    enable_compilation_cache(CFG.compilation_cache_dir)
 
 """# Reproducibility
 Sets value for random seed to produce similar result in each run.
@@ -63,10 +85,8 @@ template = """Instruction:\nBelow, the `Original Text` passage has been rewritte
 
 # template2 = """Instruction:\nBelow, the `Original Text` passage has been summarized/paraphrased/expanded/simplified into `Rewritten Text` by the `Gemma 7b-it` LLM with a certain prompt/instruction. Your task is to carefully analyze the differences between the `Original Text` and `Rewritten Text`, and try to infer the specific prompt or instruction that was likely given to the LLM to summarize/paraphrase/expand/simplify the text in this way.\n\nOriginal Text:\n{original_text}\n\nRewriten Text:\n{rewritten_text}\n\nResponse:\n{rewrite_prompt}"""
 
-df["prompt"] = df.progress_apply(lambda row: template.format(original_text=row.original_text,
-                                                             rewritten_text=row.rewritten_text,
-                                                             rewrite_prompt=row.rewrite_prompt), axis=1)
-data = df.prompt.tolist()
+# Prompts are formatted with column-wise string operations when they are needed. Training
+# tokenizes the template fields directly, so no second full copy of the dataset is kept.
 
 """Let's examine a sample prompt. As the answers in our dataset are curated with **markdown** format, we will render the sample using `Markdown()` to properly visualize the formatting.
 
@@ -80,7 +100,7 @@ def colorize_text(text):
     return text
 
 # # Take a random sample
-# sample = data[10]
+# sample = build_prompts(df.iloc[[10]], template)[0]
 
 # # Give colors to Instruction, Response and Category
 # sample = colorize_text(sample)
@@ -91,20 +111,27 @@ def colorize_text(text):
 """# Modeling
 """
 
+# With `--precision bfloat16`, the backbone computes in bfloat16 while its weights
+# (and the LoRA weights added below) stay in float32.
+set_precision(CFG.precision)
+# With `--data_parallel`, the model is replicated on every device and each training
+# batch is split between them; the LoRA gradients are all-reduced before every update.
+num_devices = data_parallel() if CFG.data_parallel else 1
+if CFG.data_parallel:
+    print(f"Training data-parallel on {num_devices} devices")
 gemma_lm = keras_nlp.models.GemmaCausalLM.from_preset(CFG.preset)
 # gemma_lm.summary()
 
 """## Gemma LM Preprocessor
 """
 
-x, y, sample_weight = gemma_lm.preprocessor(data)
-
 """This preprocessing layer will take in batches of strings, and return outputs in a `(x, y, sample_weight)` format, where the `y` label is the next token id in the `x` sequence.
 
-From the code below, we can see that, after the preprocessor, the data shape is `(num_samples, sequence_length)`.
+The whole dataset is not run through it up front: training streams batches that are tokenized on the fly by background workers (see **Training**), so memory stays flat as the dataset grows. From the code below, we can see that, after the preprocessor, the data shape is `(num_samples, sequence_length)`.
 """
 
 # # Display the shape of each processed output
+# x, y, sample_weight = gemma_lm.preprocessor(build_prompts(df.head(2), template))
 # for k, v in x.items():
 #     print(k, ":", v.shape)
 
@@ -172,18 +199,105 @@ gemma_lm.backbone.enable_lora(rank=4)
 # Limit the input sequence length to 512 (to control memory usage).
 gemma_lm.preprocessor.sequence_length = CFG.sequence_length
 
-# Compile the model with loss, optimizer, and metric
-gemma_lm.compile(
-    loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-    optimizer=keras.optimizers.Adam(learning_rate=3e-5),
-    weighted_metrics=[keras.metrics.SparseCategoricalAccuracy()],
+# The trainer runs the forward pass of `gemma_lm` on its backbone (and trains its LoRA
+# weights), building the attention mask itself so packed examples stay separate.
+# Decoder blocks selected by `remat_every`/`remat_blocks` recompute their activations
+# in the backward pass, which is what lets longer sequence lengths fit in memory.
+# With `restrict_vocabulary`, the LM head only projects to the tokens the rewrite
+# prompts of the training data are made of (plus the stop strings and the end token),
+# a small fraction of the 256k-token vocabulary. The coverage of a held-out split
+# estimates how many unseen targets that vocabulary can still produce.
+vocabulary = None
+if CFG.restrict_vocabulary:
+    tokenizer = gemma_lm.preprocessor.tokenizer
+    vocabulary_texts = dict(extra_texts=CFG.vocabulary_extra + list(CFG.stop_strings),
+                            extra_token_ids=[tokenizer.end_token_id])
+    print(held_out_coverage(tokenizer, df["rewrite_prompt"].fillna(""), held_out=CFG.vocabulary_held_out,
+                            seed=CFG.seed, **vocabulary_texts))
+    vocabulary = build_vocabulary(tokenizer, df["rewrite_prompt"].fillna(""), **vocabulary_texts)
+
+# With `loss_chunk_size`, the `[batch, sequence_length, vocabulary_size]` logits are
+# never built: the trainer computes the loss and accuracy of every token itself, a
+# chunk of positions at a time.
+trainer = CausalLMTrainer(gemma_lm, remat_every=CFG.remat_every, remat_blocks=CFG.remat_blocks,
+                          loss_chunk_size=CFG.loss_chunk_size, vocabulary=vocabulary)
+if CFG.loss_chunk_size:
+    loss = token_loss
+    accuracy = keras.metrics.MeanMetricWrapper(token_accuracy, name="sparse_categorical_accuracy")
+else:
+    loss = keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    accuracy = keras.metrics.SparseCategoricalAccuracy()
+
+# Compile the model with loss, optimizer, and metric. With `accum_steps` > 1 the
+# optimizer accumulates the LoRA gradients of that many batches and updates once,
+# for an effective batch `accum_steps` times larger at the memory cost of one.
+trainer.compile(
+    loss=loss,
+    optimizer=keras.optimizers.Adam(learning_rate=3e-5,
+                                    gradient_accumulation_steps=CFG.accum_steps if CFG.accum_steps > 1 else None),
+    weighted_metrics=[accuracy],
 )
 
+# Tokenize every field with its own token budget, so long texts are truncated
+# instead of the `Response:` section at the end of the sequence.
+template_tokenizer = TemplateTokenizer(gemma_lm.preprocessor.tokenizer, template, CFG.sequence_length,
+                                       response_budget=CFG.response_budget,
+                                       truncation=CFG.truncation)
+if CFG.token_cache_dir is not None:
+    # Only rows that are new or changed since the last run are tokenized.
+    tokenized = TokenCache(CFG.token_cache_dir, template_tokenizer, CFG.preset)(df)
+elif CFG.packing or CFG.max_batch_tokens or CFG.completion_only:
+    # Packing, token-budget batching and completion-only training need the length
+    # and response start of every row up front.
+    tokenized = template_tokenizer(df)
+else:
+    # Rows are tokenized batch by batch while training runs.
+    tokenized = LazyTokenizedRows(template_tokenizer, df)
+if CFG.packing:
+    # Several short examples share each window, with per-example attention and loss masks.
+    tokenized = PackedRows(tokenized)
+if CFG.completion_only:
+    # Only the response tokens are scored, and the LM head skips every other position.
+    tokenized = CompletionRows(tokenized, CFG.response_budget)
+batches = None
+if CFG.max_batch_tokens:
+    # Rows with the same padded length share a batch, padded only to that length.
+    batches = token_budget_batches(tokenized.lengths() - 1, CFG.max_batch_tokens * num_devices,
+                                   max_length=CFG.sequence_length, batch_multiple=num_devices)
+    print(f"{len(batches)} batches of up to {CFG.max_batch_tokens * num_devices} tokens")
+# `batch_size` rows per device; only a final partial batch is filled up with padding rows.
+train_ds = make_dataset(tokenized, CFG.batch_size * num_devices, batches=batches, shuffle=batches is not None, seed=CFG.seed,
+                        workers=CFG.data_workers, batch_multiple=num_devices,
+                        max_tokens=CFG.max_batch_tokens * num_devices if batches is not None else None)
+if vocabulary is not None:
+    train_ds = restrict_labels(train_ds, vocabulary, gemma_lm.backbone.vocabulary_size)
+if CFG.loss_chunk_size:
+    train_ds = with_labels(train_ds)
+
 # Train model
-gemma_lm.fit(data, epochs=CFG.epochs, batch_size=CFG.batch_size)
+step_stats = StepStats()
+trainer.fit(train_ds, epochs=CFG.epochs, callbacks=[LossScaleCheck(), step_stats])
+print(step_stats.report())
+print(tokenized.report())
 
 base_filename, _ = os.path.splitext(CFG.input_file_name)
-gemma_lm.save(os.path.join(CFG.dataset_path, f'finetune_{CFG.preset}_{base_filename}_epoch{CFG.epochs}.keras'))
+model_filename = os.path.join(CFG.dataset_path, f'finetune_{CFG.preset}_{base_filename}_epoch{CFG.epochs}')
+if CFG.save_format == "adapters":
+    # Only the LoRA weights changed; the base weights are rebuilt from `CFG.preset` at load time.
+    save_lora_adapters(gemma_lm, model_filename + '.lora.npz', CFG.preset, vocabulary)
+else:
+    gemma_lm.save(model_filename + '.keras')
+    save_vocabulary(model_filename + '.keras', vocabulary)
+
+"""## Merged Export
+
+With `--export_merged`, the LoRA deltas are folded into the base kernels so inference runs without the extra low-rank matmuls. The merged model must reproduce the logits of the LoRA model on a couple of training samples before it is saved.
+"""
+
+if CFG.export_merged:
+    probe_inputs, _, _ = gemma_lm.preprocessor(build_prompts(df.head(2), template))
+    rel_diff = export_merged(gemma_lm, model_filename + '.merged.keras', probe_inputs, vocabulary=vocabulary)
+    print(f"Merged model saved, max logit difference: {rel_diff:.2e} of the largest logit")
 
 """# Inference after fine-tuning
 
@@ -232,12 +346,13 @@ Let's see how our fine-tuned model responds to the same questions we asked befor
 # # Display in markdown
 # display(Markdown(output))
 
-# """# Test Data"""
+"""# Test Data"""
 
-# test_df = pd.read_csv("/kaggle/input/llm-prompt-recovery/test.csv")
-# test_df['original_text'] = test_df['original_text'].fillna("")
-# test_df['rewritten_text'] = test_df['rewritten_text'].fillna("")
-# test_df.head()
+if CFG.test_file is not None:
+    test_df = pd.read_csv(CFG.test_file)
+    test_df['original_text'] = test_df['original_text'].fillna("")
+    test_df['rewritten_text'] = test_df['rewritten_text'].fillna("")
+    test_df.head()
 
 # """## Test Sample
 
@@ -262,33 +377,38 @@ Let's see how our fine-tuned model responds to the same questions we asked befor
 # # Display in markdown
 # display(Markdown(output))
 
-# """# Submission"""
-
-# preds = []
-# for i in tqdm(range(len(test_df))):
-#     row = test_df.iloc[i]
-
-#     # Generate Prompt using template
-#     prompt = template.format(
-#         original_text=row.original_text,
-#         rewritten_text=row.rewritten_text,
-#         rewrite_prompt=""
-#     )
+"""# Submission
 
-#     # Infer
-#     output = gemma_lm.generate(prompt, max_length=512)
-#     pred = output.replace(prompt, "") # remove the prompt from output
-
-#     # Store predictions
-#     preds.append([row.id, pred])
-
-# """While preparing the submission file, we must keep in mind that, leaving any `rewrite_prompt` blank as null answers will throw an error."""
+Prompts are sorted into buckets of similar token length (padded to one of `CFG.length_buckets`, so only a fixed set of shapes is ever compiled), generated in batches of `CFG.inference_batch_size` rows inside each bucket, and put back in the original `id` order of `test_df`. The key/value cache of the constant `Instruction:` header is computed once and shared by every batch, and every row stops decoding after `CFG.max_new_tokens` tokens or as soon as it reaches the end of its answer. Duplicate rows are generated once, and with `--prediction_cache` rows predicted by an earlier run are read back from disk. With `--partial_results`, finished predictions are appended to that file after every batch, so a preempted job resumes with only the missing ids and `submission.csv` is written once every id is done. With `--quantize int8`, the LoRA weights are merged and the dense and attention kernels are quantized to int8 before decoding. With `--inference_workers`, the distinct prompts of the test set are split into shards decoded concurrently against the one loaded model; `benchmark_inference.py` measures the rows per second this gives for each number of workers. While preparing the submission file, we must keep in mind that, leaving any `rewrite_prompt` blank as null answers will throw an error, so empty predictions fall back to a default prompt.
+"""
 
-# sub_df = pd.DataFrame(preds, columns=["id", "rewrite_prompt"])
-# sub_df['rewrite_prompt'] = sub_df['rewrite_prompt'].fillna("")
-# sub_df['rewrite_prompt'] = sub_df['rewrite_prompt'].map(lambda x: "Improve the essay" if len(x) == 0 else x)
-# sub_df.to_csv("submission.csv",index=False)
-# sub_df.head()
+if CFG.test_file is not None:
+    if CFG.quantize == "int8":
+        quantize_int8(gemma_lm)
+    prediction_cache = None
+    if CFG.prediction_cache is not None:
+        prediction_cache = PredictionCache(CFG.prediction_cache, max_bytes=CFG.prediction_cache_mb * 2**20)
+    engine = InferenceEngine(gemma_lm, template,
+                             batch_size=CFG.inference_batch_size,
+                             max_new_tokens=CFG.max_new_tokens,
+                             stop_strings=CFG.stop_strings,
+                             strip_prompt=CFG.strip_prompt,
+                             prediction_cache=prediction_cache,
+                             length_buckets=CFG.length_buckets,
+                             prefix_cache=CFG.prefix_cache,
+                             vocabulary=vocabulary,
+                             sequence_length=CFG.sequence_length,
+                             response_budget=CFG.response_budget,
+                             truncation=CFG.truncation)
+    if CFG.warmup:
+        engine.warmup()
+    sub_df = engine.generate_submission(test_df, "submission.csv",
+                                        partial_path=CFG.partial_results,
+                                        num_workers=CFG.inference_workers)
+    print(engine.padding_report)
+    print(f"Shapes traced during inference: {engine.traces}, XLA compilations: {engine.compilations}, "
+          f"read from the compilation cache: {engine.cache_hits}")
+    sub_df.head()
 
 # """# Conclusion
 
@@ -1,6 +1,9 @@
 import os
 os.environ["KERAS_BACKEND"] = "jax" # you can also use tensorflow or torch
 os.environ["XLA_PYTHON_CLIENT_MEM_FRACTION"] = "1.00" # avoid memory fragmentation on JAX backend.
+# Parsed before JAX is imported, so `--host_devices` can still set its XLA flags.
+from configurations.cfg import CFG
+from configurations.cfg_gcp import CFGGCP
 
 import keras
 import keras_nlp
@@ -15,8 +18,19 @@ import plotly.express as px
 from IPython.display import display, Markdown
 
 """# Configuration"""
-from configurations.cfg import CFG
-from configurations.cfg_gcp import CFGGCP
+from inference.export import export_merged
+from training.adapters import save_lora_adapters
+from training.batching import token_budget_batches
+from training.completion import CompletionRows
+from training.distribution import data_parallel
+from training.packing import PackedRows
+from training.pipeline import LazyTokenizedRows, make_dataset
+from training.precision import LossScaleCheck, StepStats, set_precision
+from training.prompts import build_prompts
+from training.token_cache import TokenCache
+from training.tokenization import TemplateTokenizer
+from training.trainer import CausalLMTrainer, token_accuracy, token_loss, with_labels
+from training.vocabulary import build_vocabulary, held_out_coverage, restrict_labels, save_vocabulary
 
 """# Reproducibility
 Sets value for random seed to produce similar result in each run.
@@ -64,10 +78,8 @@ template = """Instruction:\nBelow, the `Original Text` passage has been rewritte
 
 # template2 = """Instruction:\nBelow, the `Original Text` passage has been summarized/paraphrased/expanded/simplified into `Rewritten Text` by the `Gemma 7b-it` LLM with a certain prompt/instruction. Your task is to carefully analyze the differences between the `Original Text` and `Rewritten Text`, and try to infer the specific prompt or instruction that was likely given to the LLM to summarize/paraphrase/expand/simplify the text in this way.\n\nOriginal Text:\n{original_text}\n\nRewriten Text:\n{rewritten_text}\n\nResponse:\n{rewrite_prompt}"""
 
-df["prompt"] = df.progress_apply(lambda row: template.format(original_text=row.original_text,
-                                                             rewritten_text=row.rewritten_text,
-                                                             rewrite_prompt=row.rewrite_prompt), axis=1)
-data = df.prompt.tolist()
+# Prompts are formatted with column-wise string operations when they are needed. Training
+# tokenizes the template fields directly, so no second full copy of the dataset is kept.
 
 """Let's examine a sample prompt. As the answers in our dataset are curated with **markdown** format, we will render the sample using `Markdown()` to properly visualize the formatting.
 
@@ -81,7 +93,7 @@ def colorize_text(text):
     return text
 
 # # Take a random sample
-# sample = data[10]
+# sample = build_prompts(df.iloc[[10]], template)[0]
 
 # # Give colors to Instruction, Response and Category
 # sample = colorize_text(sample)
@@ -92,20 +104,27 @@ def colorize_text(text):
 """# Modeling
 """
 
+# With `--precision bfloat16`, the backbone computes in bfloat16 while its weights
+# (and the LoRA weights added below) stay in float32.
+set_precision(CFGGCP.precision)
+# With `--data_parallel`, the model is replicated on every device and each training
+# batch is split between them; the LoRA gradients are all-reduced before every update.
+num_devices = data_parallel() if CFGGCP.data_parallel else 1
+if CFGGCP.data_parallel:
+    print(f"Training data-parallel on {num_devices} devices")
 gemma_lm = keras_nlp.models.GemmaCausalLM.from_preset(CFGGCP.preset)
 # gemma_lm.summary()
 
 """## Gemma LM Preprocessor
 """
 
-x, y, sample_weight = gemma_lm.preprocessor(data)
-
 """This preprocessing layer will take in batches of strings, and return outputs in a `(x, y, sample_weight)` format, where the `y` label is the next token id in the `x` sequence.
 
-From the code below, we can see that, after the preprocessor, the data shape is `(num_samples, sequence_length)`.
+The whole dataset is not run through it up front: training streams batches that are tokenized on the fly by background workers (see **Training**), so memory stays flat as the dataset grows. From the code below, we can see that, after the preprocessor, the data shape is `(num_samples, sequence_length)`.
 """
 
 # # Display the shape of each processed output
+# x, y, sample_weight = gemma_lm.preprocessor(build_prompts(df.head(2), template))
 # for k, v in x.items():
 #     print(k, ":", v.shape)
 
@@ -173,18 +192,105 @@ gemma_lm.backbone.enable_lora(rank=4)
 # Limit the input sequence length to 512 (to control memory usage).
 gemma_lm.preprocessor.sequence_length = CFGGCP.sequence_length
 
-# Compile the model with loss, optimizer, and metric
-gemma_lm.compile(
-    loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-    optimizer=keras.optimizers.Adam(learning_rate=3e-5),
-    weighted_metrics=[keras.metrics.SparseCategoricalAccuracy()],
+# The trainer runs the forward pass of `gemma_lm` on its backbone (and trains its LoRA
+# weights), building the attention mask itself so packed examples stay separate.
+# Decoder blocks selected by `remat_every`/`remat_blocks` recompute their activations
+# in the backward pass, which is what lets longer sequence lengths fit in memory.
+# With `restrict_vocabulary`, the LM head only projects to the tokens the rewrite
+# prompts of the training data are made of (plus the stop strings and the end token),
+# a small fraction of the 256k-token vocabulary. The coverage of a held-out split
+# estimates how many unseen targets that vocabulary can still produce.
+vocabulary = None
+if CFGGCP.restrict_vocabulary:
+    tokenizer = gemma_lm.preprocessor.tokenizer
+    vocabulary_texts = dict(extra_texts=CFGGCP.vocabulary_extra + list(CFGGCP.stop_strings),
+                            extra_token_ids=[tokenizer.end_token_id])
+    print(held_out_coverage(tokenizer, df["rewrite_prompt"].fillna(""), held_out=CFGGCP.vocabulary_held_out,
+                            seed=CFGGCP.seed, **vocabulary_texts))
+    vocabulary = build_vocabulary(tokenizer, df["rewrite_prompt"].fillna(""), **vocabulary_texts)
+
+# With `loss_chunk_size`, the `[batch, sequence_length, vocabulary_size]` logits are
+# never built: the trainer computes the loss and accuracy of every token itself, a
+# chunk of positions at a time.
+trainer = CausalLMTrainer(gemma_lm, remat_every=CFGGCP.remat_every, remat_blocks=CFGGCP.remat_blocks,
+                          loss_chunk_size=CFGGCP.loss_chunk_size, vocabulary=vocabulary)
+if CFGGCP.loss_chunk_size:
+    loss = token_loss
+    accuracy = keras.metrics.MeanMetricWrapper(token_accuracy, name="sparse_categorical_accuracy")
+else:
+    loss = keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    accuracy = keras.metrics.SparseCategoricalAccuracy()
+
+# Compile the model with loss, optimizer, and metric. With `accum_steps` > 1 the
+# optimizer accumulates the LoRA gradients of that many batches and updates once,
+# for an effective batch `accum_steps` times larger at the memory cost of one.
+trainer.compile(
+    loss=loss,
+    optimizer=keras.optimizers.Adam(learning_rate=3e-5,
+                                    gradient_accumulation_steps=CFGGCP.accum_steps if CFGGCP.accum_steps > 1 else None),
+    weighted_metrics=[accuracy],
 )
 
+# Tokenize every field with its own token budget, so long texts are truncated
+# instead of the `Response:` section at the end of the sequence.
+template_tokenizer = TemplateTokenizer(gemma_lm.preprocessor.tokenizer, template, CFGGCP.sequence_length,
+                                       response_budget=CFGGCP.response_budget,
+                                       truncation=CFGGCP.truncation)
+if CFGGCP.token_cache_dir is not None:
+    # Only rows that are new or changed since the last run are tokenized.
+    tokenized = TokenCache(CFGGCP.token_cache_dir, template_tokenizer, CFGGCP.preset)(df)
+elif CFGGCP.packing or CFGGCP.max_batch_tokens or CFGGCP.completion_only:
+    # Packing, token-budget batching and completion-only training need the length
+    # and response start of every row up front.
+    tokenized = template_tokenizer(df)
+else:
+    # Rows are tokenized batch by batch while training runs.
+    tokenized = LazyTokenizedRows(template_tokenizer, df)
+if CFGGCP.packing:
+    # Several short examples share each window, with per-example attention and loss masks.
+    tokenized = PackedRows(tokenized)
+if CFGGCP.completion_only:
+    # Only the response tokens are scored, and the LM head skips every other position.
+    tokenized = CompletionRows(tokenized, CFGGCP.response_budget)
+batches = None
+if CFGGCP.max_batch_tokens:
+    # Rows with the same padded length share a batch, padded only to that length.
+    batches = token_budget_batches(tokenized.lengths() - 1, CFGGCP.max_batch_tokens * num_devices,
+                                   max_length=CFGGCP.sequence_length, batch_multiple=num_devices)
+    print(f"{len(batches)} batches of up to {CFGGCP.max_batch_tokens * num_devices} tokens")
+# `batch_size` rows per device; only a final partial batch is filled up with padding rows.
+train_ds = make_dataset(tokenized, CFGGCP.batch_size * num_devices, batches=batches, shuffle=batches is not None, seed=CFGGCP.seed,
+                        workers=CFGGCP.data_workers, batch_multiple=num_devices,
+                        max_tokens=CFGGCP.max_batch_tokens * num_devices if batches is not None else None)
+if vocabulary is not None:
+    train_ds = restrict_labels(train_ds, vocabulary, gemma_lm.backbone.vocabulary_size)
+if CFGGCP.loss_chunk_size:
+    train_ds = with_labels(train_ds)
+
 # Train model
-gemma_lm.fit(data, epochs=CFGGCP.epochs, batch_size=CFGGCP.batch_size)
+step_stats = StepStats()
+trainer.fit(train_ds, epochs=CFGGCP.epochs, callbacks=[LossScaleCheck(), step_stats])
+print(step_stats.report())
+print(tokenized.report())
 
 base_filename, _ = os.path.splitext(CFG.input_file_name)
-gemma_lm.save(os.path.join(CFGGCP.dataset_path, f'finetune_{CFGGCP.preset}_{base_filename}.keras'))
+model_filename = os.path.join(CFGGCP.dataset_path, f'finetune_{CFGGCP.preset}_{base_filename}')
+if CFGGCP.save_format == "adapters":
+    # Only the LoRA weights changed; the base weights are rebuilt from `CFGGCP.preset` at load time.
+    save_lora_adapters(gemma_lm, model_filename + '.lora.npz', CFGGCP.preset, vocabulary)
+else:
+    gemma_lm.save(model_filename + '.keras')
+    save_vocabulary(model_filename + '.keras', vocabulary)
+
+"""## Merged Export
+
+With `--export_merged`, the LoRA deltas are folded into the base kernels so inference runs without the extra low-rank matmuls. The merged model must reproduce the logits of the LoRA model on a couple of training samples before it is saved.
+"""
+
+if CFGGCP.export_merged:
+    probe_inputs, _, _ = gemma_lm.preprocessor(build_prompts(df.head(2), template))
+    rel_diff = export_merged(gemma_lm, model_filename + '.merged.keras', probe_inputs, vocabulary=vocabulary)
+    print(f"Merged model saved, max logit difference: {rel_diff:.2e} of the largest logit")
 
 """# Inference after fine-tuning
 
@@ -0,0 +1,76 @@
+import json
+
+import keras
+import keras_nlp
+import numpy as np
+from keras import ops
+
+from inference.export import lora_layers
+from inference.fingerprint import base_weights_checksum
+from training.vocabulary import load_vocabulary, save_vocabulary
+
+
+def lora_variables(layers):
+    return [variable for layer in layers for variable in (layer.lora_kernel_a, layer.lora_kernel_b)]
+
+
+def save_lora_adapters(gemma_lm, path, preset, vocabulary=None):
+    """Saves only the LoRA weights of `gemma_lm` to a `.npz` file.
+
+    The file also records the base `preset` and a checksum of its frozen
+    weights, which is all `load_lora_adapters` needs to rebuild the model,
+    and the restricted `vocabulary` the weights were trained against, if any.
+    Arrays are keyed by variable path, since layer names (`query`, `value`)
+    repeat in every decoder block.
+    """
+    layers = lora_layers(gemma_lm.backbone)
+    if not layers:
+        raise ValueError("`gemma_lm` has no LoRA enabled layers to save.")
+    metadata = {
+        "preset": preset,
+        "base_checksum": base_weights_checksum(gemma_lm.backbone),
+        "rank": layers[0].lora_rank,
+        "vocabulary": None if vocabulary is None else [int(token_id) for token_id in vocabulary],
+    }
+    arrays = {variable.path: ops.convert_to_numpy(variable.value) for variable in lora_variables(layers)}
+    np.savez(path, metadata=json.dumps(metadata), **arrays)
+
+
+def read_adapters(path):
+    """The metadata and the arrays, by variable path, of a file written by `save_lora_adapters`."""
+    with np.load(path) as adapters:
+        metadata = json.loads(str(adapters["metadata"]))
+        arrays = {key: adapters[key] for key in adapters.files if key != "metadata"}
+    return metadata, arrays
+
+
+def load_lora_adapters(path, verify_checksum=True):
+    """Rebuilds a fine-tuned model from its preset and a file written by `save_lora_adapters`."""
+    metadata, arrays = read_adapters(path)
+
+    gemma_lm = keras_nlp.models.GemmaCausalLM.from_preset(metadata["preset"])
+    if verify_checksum:
+        checksum = base_weights_checksum(gemma_lm.backbone)
+        if checksum != metadata["base_checksum"]:
+            raise ValueError(f"The weights of preset `{metadata['preset']}` do not match the ones the adapters "
+                             f"were trained on (checksum {checksum}, expected {metadata['base_checksum']}).")
+
+    gemma_lm.backbone.enable_lora(rank=metadata["rank"])
+    variables = lora_variables(lora_layers(gemma_lm.backbone))
+    if sorted(variable.path for variable in variables) != sorted(arrays):
+        raise ValueError("The LoRA variables of the rebuilt model do not match the saved adapters.")
+    for variable in variables:
+        variable.assign(arrays[variable.path])
+    return gemma_lm
+
+
+def load_finetuned(path):
+    """Loads a fine-tuned model saved either as LoRA adapters (`.npz`) or as a full `.keras` file.
+
+    Returns the model and the restricted vocabulary it was trained with, or
+    None, to pass on to `InferenceEngine(vocabulary=...)`.
+    """
+    if path.endswith(".npz"):
+        vocabulary = read_adapters(path)[0].get("vocabulary")
+        return load_lora_adapters(path), None if vocabulary is None else np.array(vocabulary, dtype="int32")
+    return keras.models.load_model(path), load_vocabulary(path)
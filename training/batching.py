@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def round_up(length, multiple):
+    return -(-int(length) // multiple) * multiple
+
+
+def batch_rows(max_tokens, padded_length, batch_multiple=1):
+    """Number of rows of `padded_length` tokens in a batch of `max_tokens`, as a multiple of `batch_multiple`.
+
+    At least `batch_multiple` rows, even if they do not fit the budget.
+    """
+    return max(max_tokens // padded_length // batch_multiple, 1) * batch_multiple
+
+
+def token_budget_batches(lengths, max_tokens, length_multiple=64, max_length=None, batch_multiple=1):
+    """Groups rows into batches of at most `max_tokens` tokens, padding included.
+
+    Every row is padded to its length rounded up to `length_multiple` (and
+    cut to `max_length`), and rows with the same padded length are split
+    into batches of `batch_rows(max_tokens, padded_length, batch_multiple)`
+    rows. The last batch of a padded length can have fewer rows; with
+    `make_dataset(max_tokens=...)` it is topped up with padding rows, so
+    there is exactly one batch shape per padded length. Returns a list of
+    index arrays in order of length; shuffle them with
+    `make_dataset(shuffle=True)` so training does not see lengths in order.
+    """
+    lengths = np.asarray(lengths)
+    padded_lengths = np.array([round_up(max(length, 1), length_multiple) for length in lengths], dtype="int64")
+    if max_length is not None:
+        padded_lengths = np.minimum(padded_lengths, max_length)
+    order = np.argsort(lengths, kind="stable")
+    batches = []
+    for padded_length in np.unique(padded_lengths):
+        members = order[padded_lengths[order] == padded_length]
+        rows = batch_rows(max_tokens, int(padded_length), batch_multiple)
+        batches.extend(members[start:start + rows] for start in range(0, len(members), rows))
+    return batches
+
+
+def trim_padding(batch, length_multiple=64):
+    """Cuts the trailing padding shared by every row of an `(x, y, sample_weight)` batch.
+
+    Only arrays spanning the whole sequence are cut (not, for instance, the
+    labels of `CompletionRows`).
+    """
+    sequence_length = batch[0]["padding_mask"].shape[1]
+    length = min(round_up(max(batch[0]["padding_mask"].sum(axis=1).max(), 1), length_multiple), sequence_length)
+
+    def cut(array):
+        return array[:, :length] if array.shape[1] == sequence_length else array
+
+    x, y, sample_weight = batch
+    return {key: cut(value) for key, value in x.items()}, cut(y), cut(sample_weight)
+
+
+def pad_batch(batch, multiple):
+    """Appends padding rows, weighted 0, so the batch size of an `(x, y, sample_weight)` batch is a multiple of `multiple`."""
+    x, y, sample_weight = batch
+    missing = -len(y) % multiple
+    if not missing:
+        return batch
+
+    def pad(array):
+        return np.concatenate([array, np.zeros((missing,) + array.shape[1:], dtype=array.dtype)])
+
+    return {key: pad(value) for key, value in x.items()}, pad(y), pad(sample_weight)
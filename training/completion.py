@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class CompletionRows:
+    """Tokenized rows trained only on their response, as located by `TemplateTokenizer`.
+
+    Every batch gets `response_positions`: the `response_budget + 1` input
+    positions whose outputs predict the response tokens and the end token,
+    so the trainer only runs the LM head on those. Labels and sample weights
+    are `[batch, response_budget + 1]`; positions past the end of a row are
+    clipped to its last token and weighted 0. Same interface as
+    `TokenizedRows`; needs rows with a `response_start` (not packed rows).
+    """
+
+    def __init__(self, rows, response_budget):
+        if not hasattr(rows, "response_start"):
+            raise ValueError(f"Completion-only training needs rows with a `response_start`, "
+                             f"received: {type(rows).__name__}. It cannot be combined with packing.")
+        self.rows = rows
+        self.sequence_length = rows.sequence_length
+        self.num_positions = response_budget + 1
+
+    def __len__(self):
+        return len(self.rows)
+
+    def report(self):
+        return self.rows.report()
+
+    def lengths(self):
+        return self.rows.lengths()
+
+    def take(self, indices):
+        indices = np.asarray(indices)
+        x, y, sample_weight = self.rows.take(indices)
+        lengths = x["padding_mask"].sum(axis=1)
+        # The token at `response_start + k` is predicted from input position `response_start + k - 1`.
+        offsets = np.arange(self.num_positions)[None, :]
+        positions = self.rows.response_start[indices][:, None] - 1 + offsets
+        valid = positions < lengths[:, None]
+        positions = np.minimum(positions, lengths[:, None] - 1).astype("int32")
+        x = {**x, "response_positions": positions}
+        y = np.take_along_axis(y, positions, axis=1)
+        sample_weight = np.take_along_axis(sample_weight, positions, axis=1) & valid
+        return x, y, sample_weight
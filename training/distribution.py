@@ -0,0 +1,21 @@
+import keras
+
+
+def data_parallel(num_devices=None):
+    """Trains every model built afterwards data-parallel on the first `num_devices` devices (all by default).
+
+    Every variable, including the frozen backbone, is replicated on each
+    device and every batch is split along its first axis between them, so
+    batch sizes must be a multiple of the number of devices (see
+    `make_dataset`). The LoRA gradients are all-reduced by XLA before the
+    optimizer update. Must be called before the model is built. Returns the
+    number of devices.
+    """
+    devices = keras.distribution.list_devices()
+    if num_devices is not None:
+        if num_devices > len(devices):
+            raise ValueError(f"Data-parallel training on {num_devices} devices was requested, but only "
+                             f"{len(devices)} are available (see `--host_devices` on CPU).")
+        devices = devices[:num_devices]
+    keras.distribution.set_distribution(keras.distribution.DataParallel(devices=devices))
+    return len(devices)
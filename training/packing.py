@@ -0,0 +1,70 @@
+import bisect
+
+import numpy as np
+
+
+class PackedRows:
+    """Several tokenized rows packed into each `sequence_length + 1` token window.
+
+    Rows are placed best-fit in order of decreasing length. Every token gets
+    the 1-based index of its row within the window as segment id (0 for
+    padding); the segment ids keep rows from attending to each other, and
+    labels are only weighted where the next token belongs to the same row.
+    Same interface as `TokenizedRows`, with one item per window.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.sequence_length = rows.sequence_length
+        self.pad_token_id = getattr(rows, "pad_token_id", 0)
+        window_length = self.sequence_length + 1
+        lengths = rows.lengths()
+
+        self.windows, free = [], []
+        for index in np.argsort(-lengths, kind="stable"):
+            length = int(lengths[index])
+            # Best fit: the fullest window that still has room for the row.
+            position = bisect.bisect_left(free, (length, -1))
+            if position < len(free):
+                space, window = free.pop(position)
+            else:
+                space, window = window_length, len(self.windows)
+                self.windows.append([])
+            self.windows[window].append(int(index))
+            if space > length:
+                bisect.insort(free, (space - length, window))
+        self.efficiency = float(lengths.sum()) / max(len(self.windows) * window_length, 1)
+        self._window_lengths = np.array([lengths[members].sum() for members in self.windows])
+
+    def __len__(self):
+        return len(self.windows)
+
+    def report(self):
+        report = self.rows.report()
+        report.update({"packed_windows": len(self.windows), "packing_efficiency": self.efficiency})
+        return report
+
+    def lengths(self):
+        return self._window_lengths
+
+    def take(self, indices):
+        window_length = self.sequence_length + 1
+        token_ids = np.full([len(indices), window_length], self.pad_token_id, dtype="int32")
+        segment_ids = np.zeros([len(indices), window_length], dtype="int32")
+        for row, window in enumerate(indices):
+            members = self.windows[window]
+            start = 0
+            for segment, ids in enumerate(self.rows.row_token_ids(members), start=1):
+                token_ids[row, start:start + len(ids)] = ids
+                segment_ids[row, start:start + len(ids)] = segment
+                start += len(ids)
+        padding_mask = segment_ids > 0
+        x = {"token_ids": token_ids[:, :-1],
+             "padding_mask": padding_mask[:, :-1],
+             "segment_ids": segment_ids[:, :-1]}
+        # Only predict the next token inside the same row.
+        sample_weight = padding_mask[:, 1:] & (segment_ids[:, 1:] == segment_ids[:, :-1])
+        return x, token_ids[:, 1:], sample_weight
+
+    def to_arrays(self):
+        return self.take(np.arange(len(self)))
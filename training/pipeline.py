@@ -0,0 +1,96 @@
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from training.batching import batch_rows, pad_batch, trim_padding
+from training.tokenization import truncation_report
+
+
+class LazyTokenizedRows:
+    """Rows of `df` tokenized by `template_tokenizer` only when a batch of them is taken.
+
+    Same interface as `TokenizedRows`; the truncation report covers the rows
+    taken so far.
+    """
+
+    def __init__(self, template_tokenizer, df):
+        self.template_tokenizer = template_tokenizer
+        self.df = df
+        self.sequence_length = template_tokenizer.sequence_length
+        self.dropped_tokens = np.zeros(len(df), dtype="int64")
+        self._taken = np.zeros(len(df), dtype=bool)
+
+    def __len__(self):
+        return len(self.df)
+
+    def report(self):
+        return truncation_report(self.dropped_tokens[self._taken])
+
+    def take(self, indices):
+        tokenized = self.template_tokenizer(self.df.iloc[indices])
+        self.dropped_tokens[indices] = tokenized.dropped_tokens
+        self._taken[indices] = True
+        return tokenized.to_arrays()
+
+
+def prefetch_map(fn, items, workers=2, depth=4):
+    """Yields `fn(item)` for every item in order, computing up to `depth` results ahead in worker threads."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def make_dataset(rows, batch_size=None, batches=None, shuffle=False, seed=None, workers=2, prefetch=4,
+                 length_multiple=64, batch_multiple=1, max_tokens=None):
+    """Streams `(x, y, sample_weight)` batches of `rows` as a `tf.data.Dataset`.
+
+    `rows` is anything with `__len__` and `take(indices)` (`TokenizedRows`,
+    `CachedRows`, `LazyTokenizedRows`, `PackedRows`). Batches are either
+    `batch_size` consecutive rows or the given list of index arrays
+    `batches` (see `token_budget_batches`); in the latter case every batch is
+    only padded to its longest row, rounded up to `length_multiple`. With
+    `batch_multiple`, batches are filled up with padding rows to a multiple
+    of that many rows (the number of data-parallel devices), and with the
+    `max_tokens` the `batches` were made for, to the full number of rows of
+    their padded length, so that every padded length has one shape. Batches are
+    packed by `workers` background threads, `prefetch` batches ahead of
+    training, so only a few batches are ever held in memory.
+    """
+    def take(indices):
+        batch = rows.take(indices)
+        if batches is not None:
+            batch = trim_padding(batch, length_multiple)
+            if max_tokens is not None:
+                return pad_batch(batch, batch_rows(max_tokens, batch[0]["padding_mask"].shape[1], batch_multiple))
+        return pad_batch(batch, batch_multiple)
+
+    # Every array is `[batch, length]`; the keys of `x` depend on `rows`.
+    signature = tf.nest.map_structure(lambda array: tf.TensorSpec([None, None], tf.as_dtype(array.dtype)),
+                                      rows.take([0]))
+    epochs = itertools.count()
+
+    def index_batches():
+        if batches is not None:
+            order = list(batches)
+            if shuffle:
+                np.random.default_rng(None if seed is None else seed + next(epochs)).shuffle(order)
+            return order
+        order = np.arange(len(rows))
+        if shuffle:
+            np.random.default_rng(None if seed is None else seed + next(epochs)).shuffle(order)
+        return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+    def generate():
+        yield from prefetch_map(take, index_batches(), workers=workers, depth=prefetch)
+
+    num_batches = len(batches) if batches is not None else -(-len(rows) // batch_size)
+    dataset = tf.data.Dataset.from_generator(generate, output_signature=signature)
+    return dataset.apply(tf.data.experimental.assert_cardinality(num_batches)).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,68 @@
+import math
+import resource
+import time
+
+import jax
+import keras
+import numpy as np
+
+PRECISION_POLICIES = {"float32": "float32", "bfloat16": "mixed_bfloat16"}
+
+
+def set_precision(precision):
+    """Sets the Keras dtype policy of every model built afterwards.
+
+    `"bfloat16"` computes in bfloat16 but keeps every variable (the base and
+    LoRA weights, and so the optimizer state built from the trainable ones)
+    in float32. Must be called before the model is built.
+    """
+    keras.mixed_precision.set_global_policy(PRECISION_POLICIES[precision])
+
+
+def peak_memory_mb():
+    """Peak memory of the first accelerator, or of the host process when the device does not report it."""
+    stats = jax.local_devices()[0].memory_stats() or {}
+    if "peak_bytes_in_use" in stats:
+        return stats["peak_bytes_in_use"] / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class LossScaleCheck(keras.callbacks.Callback):
+    """Stops training as soon as the loss is not finite.
+
+    bfloat16 has the exponent range of float32, so unlike float16 it trains
+    without loss scaling; a non-finite loss means that assumption failed
+    (or the learning rate is too high) and the run should be repeated with
+    `--precision float32`.
+    """
+
+    def on_train_batch_end(self, batch, logs=None):
+        loss = (logs or {}).get("loss")
+        if loss is not None and not math.isfinite(float(loss)):
+            print(f"Batch {batch}: loss is {loss} under the "
+                  f"{keras.mixed_precision.global_policy().name} policy, stopping training.")
+            self.model.stop_training = True
+
+
+class StepStats(keras.callbacks.Callback):
+    """Records the time of every training step and the peak memory of the run.
+
+    The first step, which includes compilation, is left out of the step time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.step_times = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_times.append(time.perf_counter() - self._start)
+
+    def report(self):
+        step_times = self.step_times[1:] or self.step_times
+        return {"policy": keras.mixed_precision.global_policy().name,
+                "steps": len(self.step_times),
+                "step_seconds": float(np.median(step_times)) if step_times else float("nan"),
+                "peak_memory_mb": peak_memory_mb()}
@@ -0,0 +1,28 @@
+import string
+
+import numpy as np
+
+
+def _segments(template):
+    return [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+
+def build_prompts(df, template, **values):
+    """Formats `template` for every row of `df` with column-wise string concatenation.
+
+    Fields are filled from the columns of `df` with the same name, unless a
+    constant is given for them in `values` (e.g. `rewrite_prompt=""`).
+    Returns a plain list of strings without adding a column to `df`.
+    """
+    prompts = np.full(len(df), "", dtype=object)
+    for literal, field in _segments(template):
+        if literal:
+            prompts = prompts + literal
+        if field is None:
+            continue
+        if field in values:
+            prompts = prompts + str(values[field])
+        else:
+            prompts = prompts + df[field].astype(str).to_numpy(dtype=object)
+    return prompts.tolist()
+
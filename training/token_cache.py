@@ -0,0 +1,160 @@
+import fcntl
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+from training.tokenization import pack_token_ids, truncation_report
+
+
+class CachedRows:
+    """Tokenized rows read from the memory-mapped shards of a `TokenCache`.
+
+    Same interface as `TokenizedRows`: rows are only read from disk when
+    `take` packs them into a batch.
+    """
+
+    def __init__(self, shards, shard_index, offset, sequence_length):
+        self.shards = shards
+        self.shard_index = shard_index
+        self.offset = offset
+        self.sequence_length = sequence_length
+        self.response_start = self._gather("response_start")
+        self.dropped_tokens = self._gather("dropped_tokens")
+
+    def _gather(self, name):
+        values = np.zeros(len(self), dtype="int64")
+        for shard, arrays in enumerate(self.shards):
+            rows = self.shard_index == shard
+            values[rows] = arrays[name][self.offset[rows]]
+        return values
+
+    def __len__(self):
+        return len(self.offset)
+
+    def report(self):
+        return truncation_report(self.dropped_tokens)
+
+    def lengths(self):
+        return self._gather("lengths")
+
+    def row_token_ids(self, indices):
+        token_ids = []
+        for index in indices:
+            arrays = self.shards[self.shard_index[index]]
+            offset = self.offset[index]
+            token_ids.append(arrays["token_ids"][offset, :arrays["lengths"][offset]])
+        return token_ids
+
+    def take(self, indices):
+        indices = np.asarray(indices)
+        token_ids = np.empty([len(indices), self.sequence_length + 1], dtype="int32")
+        lengths = np.empty(len(indices), dtype="int64")
+        for shard, arrays in enumerate(self.shards):
+            rows = np.flatnonzero(self.shard_index[indices] == shard)
+            if len(rows):
+                offsets = self.offset[indices[rows]]
+                token_ids[rows] = arrays["token_ids"][offsets]
+                lengths[rows] = arrays["lengths"][offsets]
+        return pack_token_ids(token_ids, lengths)
+
+    def to_arrays(self):
+        return self.take(np.arange(len(self)))
+
+
+class TokenCache:
+    """Content-addressed on-disk cache of the rows tokenized by a `TemplateTokenizer`.
+
+    Each cache directory is keyed by the preset, the template and every
+    setting of the tokenizer, and holds shards of padded token ids as `.npy`
+    memory maps plus an index from row content hash to shard and offset.
+    Calling the cache on a dataframe only tokenizes the rows it has not seen
+    before, appends them as a new shard, and returns `CachedRows` backed by
+    the memory maps.
+
+    Several jobs can share a cache directory: shards get unique names, and
+    the index is re-read and merged with the new rows under a file lock
+    before it is replaced.
+    """
+
+    def __init__(self, directory, template_tokenizer, preset):
+        self.template_tokenizer = template_tokenizer
+        self.sequence_length = template_tokenizer.sequence_length
+        key = json.dumps({"format": 2,
+                          "preset": preset,
+                          "vocabulary_size": template_tokenizer.tokenizer.vocabulary_size(),
+                          "segments": template_tokenizer.segments,
+                          "sequence_length": template_tokenizer.sequence_length,
+                          "response_field": template_tokenizer.response_field,
+                          "response_budget": template_tokenizer.response_budget,
+                          "truncation": template_tokenizer.truncation}, sort_keys=True)
+        self.directory = os.path.join(directory, hashlib.sha256(key.encode()).hexdigest()[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.index = self._read_index()
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def row_hashes(self, df):
+        columns = [df[field].fillna("").astype(str).tolist() for field in self.template_tokenizer.fields]
+        return [hashlib.sha256(json.dumps(values).encode()).hexdigest() for values in zip(*columns)]
+
+    def _shard_path(self, shard, name):
+        return os.path.join(self.directory, f"shard_{shard}_{name}.npy")
+
+    def _write_shard(self, tokenized):
+        # Unique across jobs writing to the same directory at the same time.
+        shard = uuid.uuid4().hex
+        token_ids = np.lib.format.open_memmap(self._shard_path(shard, "token_ids"), mode="w+", dtype="int32",
+                                              shape=(len(tokenized), self.sequence_length + 1))
+        token_ids[:] = tokenized.pad_token_id
+        for row, ids in enumerate(tokenized.token_ids):
+            token_ids[row, :len(ids)] = ids
+        token_ids.flush()
+        del token_ids
+        np.save(self._shard_path(shard, "lengths"), np.array([len(ids) for ids in tokenized.token_ids]))
+        np.save(self._shard_path(shard, "response_start"), tokenized.response_start.astype("int64"))
+        np.save(self._shard_path(shard, "dropped_tokens"), tokenized.dropped_tokens.astype("int64"))
+        return shard
+
+    def _save_index(self, new_rows):
+        """Adds `new_rows` to the index on disk, keeping the rows other jobs added since it was read."""
+        with open(os.path.join(self.directory, "index.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            for row_hash, location in new_rows.items():
+                index.setdefault(row_hash, location)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        self.index = index
+
+    def _load_shard(self, shard):
+        return {name: np.load(self._shard_path(shard, name), mmap_mode="r")
+                for name in ("token_ids", "lengths", "response_start", "dropped_tokens")}
+
+    def __call__(self, df):
+        hashes = self.row_hashes(df)
+        missing = {}
+        for row, row_hash in enumerate(hashes):
+            if row_hash not in self.index and row_hash not in missing:
+                missing[row_hash] = row
+        if missing:
+            tokenized = self.template_tokenizer(df.iloc[list(missing.values())])
+            shard = self._write_shard(tokenized)
+            self._save_index({row_hash: [shard, offset] for offset, row_hash in enumerate(missing)})
+
+        locations = [self.index[row_hash] for row_hash in hashes]
+        names = sorted({shard for shard, _ in locations})
+        positions = {shard: position for position, shard in enumerate(names)}
+        shards = [self._load_shard(shard) for shard in names]
+        shard_index = np.array([positions[shard] for shard, _ in locations], dtype="int64")
+        offset = np.array([offset for _, offset in locations], dtype="int64")
+        return CachedRows(shards, shard_index, offset, self.sequence_length)
@@ -0,0 +1,159 @@
+import string
+from dataclasses import dataclass
+
+import numpy as np
+
+from inference.tokens import tokenize_texts
+
+
+@dataclass
+class TokenizedRows:
+    """Token ids of every formatted row, with where its response starts and how much was truncated."""
+    token_ids: list
+    response_start: np.ndarray
+    dropped_tokens: np.ndarray
+    sequence_length: int
+    pad_token_id: int = 0
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def report(self):
+        return truncation_report(self.dropped_tokens)
+
+    def lengths(self):
+        return np.array([len(ids) for ids in self.token_ids])
+
+    def row_token_ids(self, indices):
+        return [self.token_ids[index] for index in indices]
+
+    def take(self, indices):
+        """Packs the given rows like `GemmaCausalLMPreprocessor` into `(x, y, sample_weight)`."""
+        token_ids = np.full([len(indices), self.sequence_length + 1], self.pad_token_id, dtype="int32")
+        for row, index in enumerate(indices):
+            ids = self.token_ids[index]
+            token_ids[row, :len(ids)] = ids
+        lengths = np.array([len(self.token_ids[index]) for index in indices])
+        return pack_token_ids(token_ids, lengths)
+
+    def to_arrays(self):
+        return self.take(np.arange(len(self)))
+
+
+def truncation_report(dropped_tokens):
+    truncated = dropped_tokens > 0
+    return {"rows": len(dropped_tokens),
+            "truncated_rows": int(truncated.sum()),
+            "dropped_tokens": int(dropped_tokens.sum()),
+            "max_dropped_tokens": int(dropped_tokens.max(initial=0)),
+            "mean_dropped_tokens_per_truncated_row": float(dropped_tokens[truncated].mean()) if truncated.any() else 0.0}
+
+
+def pack_token_ids(token_ids, lengths):
+    """Splits padded `[batch, sequence_length + 1]` token ids into `(x, y, sample_weight)`."""
+    padding_mask = np.arange(token_ids.shape[1])[None, :] < np.asarray(lengths)[:, None]
+    x = {"token_ids": token_ids[:, :-1], "padding_mask": padding_mask[:, :-1]}
+    return x, token_ids[:, 1:], padding_mask[:, 1:]
+
+
+def truncate(token_ids, budget, truncation="middle"):
+    """Cuts `token_ids` down to `budget` tokens, removing them from the middle or the head."""
+    if len(token_ids) <= budget:
+        return token_ids
+    if budget <= 0:
+        return []
+    if truncation == "head":
+        return token_ids[-budget:]
+    head = budget // 2
+    return token_ids[:head] + token_ids[len(token_ids) - (budget - head):]
+
+
+class TemplateTokenizer:
+    """Tokenizes dataframe rows through `template` with a token budget per field.
+
+    The literal parts of the template (the instruction and section headers)
+    and the response field are always kept, so the `Response:` target can no
+    longer be cut off the end of a long row. The response gets up to
+    `response_budget` tokens, and whatever is left of `sequence_length` is
+    shared between the other fields: a field shorter than its share hands
+    the surplus to the others, and longer ones are truncated from the middle
+    or the head. Rows get the same start and end tokens as with
+    `GemmaCausalLMPreprocessor`.
+    """
+
+    def __init__(self, tokenizer, template, sequence_length, response_field="rewrite_prompt",
+                 response_budget=64, truncation="middle"):
+        if truncation not in ("middle", "head"):
+            raise ValueError(f"`truncation` must be 'middle' or 'head', received: {truncation}")
+        self.tokenizer = tokenizer
+        self.sequence_length = sequence_length
+        self.response_field = response_field
+        self.response_budget = response_budget
+        self.truncation = truncation
+
+        self.segments = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+        literal_ids = tokenize_texts(tokenizer, [literal for literal, _ in self.segments])
+        self.literal_ids = [ids if literal else [] for ids, (literal, _) in zip(literal_ids, self.segments)]
+        self.fields = [field for _, field in self.segments if field is not None]
+        # Start and end token, plus every literal part of the template.
+        self.fixed_length = 2 + sum(len(ids) for ids in self.literal_ids)
+        if self.fixed_length + response_budget > sequence_length + 1:
+            raise ValueError(f"`sequence_length={sequence_length}` leaves no room for the text fields: the template "
+                             f"takes {self.fixed_length} tokens and the response up to {response_budget}.")
+
+    def _field_budgets(self, lengths):
+        """Splits the space left by the template and the response between the other fields."""
+        budgets = {self.response_field: min(lengths[self.response_field], self.response_budget)}
+        available = self.sequence_length + 1 - self.fixed_length - budgets[self.response_field]
+        others = sorted((field for field in lengths if field != self.response_field), key=lambda field: lengths[field])
+        for i, field in enumerate(others):
+            share = available // (len(others) - i)
+            budgets[field] = min(lengths[field], share)
+            available -= budgets[field]
+        return budgets
+
+    def __call__(self, df):
+        return self._tokenize(df)
+
+    def prompt_ids(self, df):
+        """Token ids of every row of `df` up to where its response starts, tokenized as in training.
+
+        The other fields get the budgets they would get next to a response
+        of the full `response_budget`, so a prompt is never longer than the
+        ones seen in training. `df` needs no response column.
+        """
+        df = df.assign(**{self.response_field: ""})
+        tokenized = self._tokenize(df, response_length=self.response_budget)
+        return [ids[:start] for ids, start in zip(tokenized.token_ids, tokenized.response_start)]
+
+    def _tokenize(self, df, response_length=None):
+        field_ids = {field: tokenize_texts(self.tokenizer, df[field].fillna("").astype(str))
+                     for field in self.fields}
+        token_ids, response_start, dropped_tokens = [], [], []
+        for row in range(len(df)):
+            lengths = {field: len(field_ids[field][row]) for field in self.fields}
+            if response_length is None:
+                budgets = self._field_budgets(lengths)
+            else:
+                budgets = self._field_budgets({**lengths, self.response_field: response_length})
+            ids = [self.tokenizer.start_token_id]
+            start = None
+            for (literal, field), literal_ids in zip(self.segments, self.literal_ids):
+                ids += literal_ids
+                if field is None:
+                    continue
+                if field == self.response_field:
+                    start = len(ids)
+                    ids += field_ids[field][row][:budgets[field]]
+                else:
+                    ids += truncate(field_ids[field][row], budgets[field], self.truncation)
+            ids.append(self.tokenizer.end_token_id)
+            token_ids.append(ids)
+            response_start.append(start)
+            dropped_tokens.append(sum(lengths.values()) - sum(budgets.values()))
+        return TokenizedRows(token_ids=token_ids,
+                             response_start=np.array(response_start),
+                             dropped_tokens=np.array(dropped_tokens),
+                             sequence_length=self.sequence_length,
+                             pad_token_id=self.tokenizer.pad_token_id)
+
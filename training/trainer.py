@@ -0,0 +1,150 @@
+import jax
+import jax.numpy as jnp
+import keras
+from keras import ops
+
+
+def attention_mask(padding_mask, segment_ids=None):
+    """Causal attention mask that also keeps packed examples (`segment_ids`) from attending to each other."""
+    sequence_length = ops.shape(padding_mask)[1]
+    causal_mask = ops.tril(ops.ones((sequence_length, sequence_length), dtype="bool"))
+    mask = ops.logical_and(causal_mask[None, :, :], ops.cast(padding_mask, "bool")[:, None, :])
+    if segment_ids is not None:
+        mask = ops.logical_and(mask, ops.equal(segment_ids[:, :, None], segment_ids[:, None, :]))
+    return mask
+
+
+def decoder_block(block, x, mask, training=None):
+    """Same computation as `GemmaDecoderBlock.call`, with an explicit attention mask."""
+    normalized_x = block.pre_attention_norm(x)
+    attention = block.attention(normalized_x, attention_mask=mask, training=training)
+    if block.dropout:
+        attention = block.attention_dropout(attention, training=training)
+    attention_x = x + attention
+    normalized_x = block.pre_ffw_norm(attention_x)
+    x1 = block.gating_ffw(normalized_x)
+    x2 = block.gating_ffw_2(normalized_x)
+    x = keras.activations.gelu(x1, approximate=True) * x2
+    x = block.ffw_linear(x)
+    return x + attention_x
+
+
+def remat_segments(num_blocks, every=0, blocks=()):
+    """Splits the decoder blocks into consecutive segments, each flagged for rematerialization.
+
+    With `every` = k, every run of k blocks is one rematerialized segment:
+    only its input is kept for the backward pass and the k blocks are
+    recomputed from it. Otherwise, every block listed in `blocks` is
+    rematerialized on its own. Returns a list of `(block_indices, remat)`.
+    """
+    if every:
+        return [(list(range(start, min(start + every, num_blocks))), True)
+                for start in range(0, num_blocks, every)]
+    blocks = set(blocks)
+    return [([index], index in blocks) for index in range(num_blocks)]
+
+
+def chunked_token_outputs(hidden_states, embeddings, labels, chunk_size):
+    """Per-token loss and accuracy of `labels`, computed `chunk_size` positions at a time.
+
+    Only one `[batch, chunk_size, vocabulary_size]` block of logits exists at
+    any time: chunks are projected through the tied `embeddings` one after
+    the other, and rematerialized in the backward pass instead of kept.
+    Returns `[batch, length, 2]` with the negative log-likelihood of every
+    label and whether it is the argmax in the last axis.
+    """
+    batch_size, length, hidden_dim = hidden_states.shape
+    num_chunks = -(-length // chunk_size)
+    padding = num_chunks * chunk_size - length
+    hidden_states = jnp.pad(hidden_states, [(0, 0), (0, padding), (0, 0)])
+    labels = jnp.pad(labels, [(0, 0), (0, padding)])
+    # `[num_chunks, batch, chunk_size, ...]`, scanned over the first axis.
+    hidden_states = hidden_states.reshape(batch_size, num_chunks, chunk_size, hidden_dim).swapaxes(0, 1)
+    labels = labels.reshape(batch_size, num_chunks, chunk_size).swapaxes(0, 1)
+
+    @jax.checkpoint
+    def chunk_outputs(chunk):
+        hidden_states, labels = chunk
+        logits = jnp.einsum("btd,vd->btv", hidden_states, embeddings).astype("float32")
+        label_logits = jnp.take_along_axis(logits, labels[..., None], axis=-1)[..., 0]
+        loss = jax.nn.logsumexp(logits, axis=-1) - label_logits
+        correct = (jnp.argmax(logits, axis=-1) == labels).astype("float32")
+        return jnp.stack([loss, correct], axis=-1)
+
+    outputs = jax.lax.map(chunk_outputs, (hidden_states, labels))
+    return outputs.swapaxes(0, 1).reshape(batch_size, num_chunks * chunk_size, 2)[:, :length]
+
+
+def token_loss(y_true, y_pred):
+    """Loss for a trainer with `loss_chunk_size`, whose outputs already hold the loss of every token."""
+    return y_pred[..., 0]
+
+
+def token_accuracy(y_true, y_pred):
+    return y_pred[..., 1]
+
+
+def with_labels(dataset):
+    """Adds the labels of every `(x, y, sample_weight)` batch to `x`, as a trainer with `loss_chunk_size` expects."""
+    return dataset.map(lambda x, y, sample_weight: ({**x, "labels": y}, y, sample_weight))
+
+
+class CausalLMTrainer(keras.Model):
+    """Trains the backbone of `gemma_lm` through its own decoder forward pass.
+
+    The forward pass is the one of `GemmaCausalLM`, but the attention mask is
+    built here, so inputs may carry `segment_ids` for several examples packed
+    into one sequence. Shares its variables with `gemma_lm`, so the LoRA
+    weights trained here are the ones used for generation afterwards.
+
+    `remat_every` and `remat_blocks` select decoder blocks whose activations
+    are recomputed in the backward pass instead of kept (see
+    `remat_segments`), trading compute for activation memory.
+
+    With `loss_chunk_size`, the full-vocabulary logits are never built:
+    inputs must also carry the `labels` (see `with_labels`), and the outputs
+    are the per-token loss and accuracy of `chunked_token_outputs`, to be
+    compiled with `token_loss` and `token_accuracy`. When inputs carry
+    `response_positions` (see `CompletionRows`), the LM head only runs on
+    the hidden states at those positions. With a `vocabulary` of token ids,
+    the LM head only projects to those (see `restrict_labels`), and outputs
+    and labels index into `vocabulary`.
+    """
+
+    def __init__(self, gemma_lm, remat_every=0, remat_blocks=(), loss_chunk_size=None, vocabulary=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.backbone = gemma_lm.backbone
+        self.loss_chunk_size = loss_chunk_size
+        self.vocabulary = vocabulary
+        self.segments = remat_segments(len(self.backbone.transformer_layers), remat_every, remat_blocks)
+
+    def _run_blocks(self, x, mask, training=None):
+        layers = self.backbone.transformer_layers
+        for blocks, remat in self.segments:
+            def run(x, mask, blocks=blocks):
+                for index in blocks:
+                    x = decoder_block(layers[index], x, mask, training=training)
+                return x
+            x = jax.checkpoint(run)(x, mask) if remat else run(x, mask)
+        return x
+
+    def call(self, inputs, training=None):
+        backbone = self.backbone
+        mask = attention_mask(inputs["padding_mask"], inputs.get("segment_ids"))
+        x = backbone.token_embedding(inputs["token_ids"])
+        x = x * ops.cast(ops.sqrt(backbone.hidden_dim), x.dtype)
+        x = self._run_blocks(x, mask, training=training)
+        x = backbone.layer_norm(x)
+        if "response_positions" in inputs:
+            x = ops.take_along_axis(x, ops.expand_dims(inputs["response_positions"], -1), axis=1)
+        # The loss is computed in float32 whatever the compute dtype.
+        if self.loss_chunk_size is None and self.vocabulary is None:
+            return ops.cast(backbone.token_embedding(x, reverse=True), "float32")
+        embeddings = backbone.token_embedding.embeddings
+        if self.vocabulary is not None:
+            embeddings = ops.take(embeddings, self.vocabulary, axis=0)
+        embeddings = ops.cast(embeddings, x.dtype)
+        if self.loss_chunk_size:
+            return chunked_token_outputs(x, embeddings, inputs["labels"], self.loss_chunk_size)
+        return ops.cast(ops.matmul(x, ops.transpose(embeddings)), "float32")
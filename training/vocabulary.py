@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from inference.tokens import tokenize_texts
+
+
+def build_vocabulary(tokenizer, texts, extra_texts=(), extra_token_ids=()):
+    """Sorted ids of every token of `texts` and `extra_texts`, plus `extra_token_ids`."""
+    vocabulary = set(int(token_id) for token_id in extra_token_ids)
+    for token_ids in tokenize_texts(tokenizer, list(texts) + list(extra_texts)):
+        vocabulary.update(token_ids)
+    return np.array(sorted(vocabulary), dtype="int32")
+
+
+def vocabulary_coverage(tokenizer, vocabulary, texts):
+    """How many of the tokens of `texts`, and how many whole texts, `vocabulary` can produce."""
+    covered = [np.isin(token_ids, vocabulary) for token_ids in tokenize_texts(tokenizer, list(texts))]
+    num_tokens = sum(len(row) for row in covered)
+    return {"vocabulary_size": len(vocabulary),
+            "rows": len(covered),
+            "token_coverage": sum(int(row.sum()) for row in covered) / max(num_tokens, 1),
+            "row_coverage": float(np.mean([row.all() for row in covered])) if covered else 0.0}
+
+
+def held_out_coverage(tokenizer, texts, extra_texts=(), extra_token_ids=(), held_out=0.1, seed=None):
+    """Coverage of a random `held_out` fraction of `texts` by a vocabulary built from the rest.
+
+    Estimates how well a vocabulary built from every training text covers
+    the targets of unseen rows.
+    """
+    texts = np.asarray(list(texts), dtype=object)
+    order = np.random.default_rng(seed).permutation(len(texts))
+    num_held_out = max(int(len(texts) * held_out), 1)
+    vocabulary = build_vocabulary(tokenizer, texts[order[num_held_out:]], extra_texts, extra_token_ids)
+    return vocabulary_coverage(tokenizer, vocabulary, texts[order[:num_held_out]])
+
+
+def restrict_labels(dataset, vocabulary, vocabulary_size):
+    """Maps the labels of `(x, y, sample_weight)` batches to their index in `vocabulary`.
+
+    Labels outside the vocabulary cannot be predicted by a restricted head,
+    so they are given a weight of 0.
+    """
+    table = np.full(vocabulary_size, -1, dtype="int32")
+    table[vocabulary] = np.arange(len(vocabulary), dtype="int32")
+    table = tf.constant(table)
+
+    def remap(x, y, sample_weight):
+        labels = tf.gather(table, y)
+        known = labels >= 0
+        sample_weight = tf.cast(tf.logical_and(tf.cast(sample_weight, tf.bool), known), sample_weight.dtype)
+        return x, tf.where(known, labels, 0), sample_weight
+
+    return dataset.map(remap)
+
+
+def vocabulary_path(model_path):
+    return model_path + ".vocabulary.npy"
+
+
+def save_vocabulary(model_path, vocabulary):
+    """Saves the restricted `vocabulary` a model was trained with next to the model at `model_path`.
+
+    Without a vocabulary, a file left there by an earlier model is removed
+    so that `load_vocabulary` does not restrict the new one.
+    """
+    path = vocabulary_path(model_path)
+    if vocabulary is not None:
+        np.save(path, np.asarray(vocabulary, dtype="int32"))
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def load_vocabulary(model_path):
+    """The vocabulary saved by `save_vocabulary` for the model at `model_path`, or None."""
+    path = vocabulary_path(model_path)
+    return np.load(path) if os.path.exists(path) else None